@@ -0,0 +1,7 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+"""Benchmarks for the MultiProduct plug-in, see `benchmarks.run`."""
@@ -0,0 +1,226 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+"""Times the hot paths of the MultiProduct plug-in against a throwaway Trac
+environment filled with a synthetic catalog and tickets.
+
+    $ python -m benchmarks.run --products 50 --components 20 --versions 20 \\
+          --tickets 20000 --output results.json
+
+Results are written as JSON so that runs against different commits can be
+compared.  The ticket field benchmark only exercises depselect fields when Trac
+has been patched as described in the README."""
+
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from genshi.input import HTML
+
+from trac import __version__ as trac_version
+from trac.env import Environment
+from trac.ticket.api import TicketSystem
+from trac.ticket.model import Ticket
+from trac.util.datefmt import utc, to_timestamp
+from trac.web.href import Href
+
+from multiproduct import model
+from multiproduct.api import ProductSystem
+# Registers the setup participant that creates the plug-in's tables, which
+# would otherwise only happen when the plug-in is installed as an egg
+from multiproduct.main import MultiProductPlugin
+from multiproduct.ticket import TicketExtensions
+
+
+class Request(object):
+    """Just enough of a request for the template filter and ticket
+    manipulator."""
+
+    def __init__(self):
+        self.href = self.abs_href = Href('/trac')
+        self.chrome = {}
+        self.args = {}
+        self.authname = 'admin'
+
+
+def create_environment(path):
+    return Environment(path, create=True,
+                       options=[('components', 'multiproduct.*', 'enabled'),
+                                ('trac', 'database', 'sqlite:db/trac.db')])
+
+
+def populate(env, products, components, versions, tickets):
+    """Creates `products` products, each with `components` components and
+    `versions` versions, and spreads `tickets` tickets evenly across them."""
+    db = env.get_db_cnx()
+    cursor = db.cursor()
+    model.Product.insert_many(env,
+        [('product%d' % p, 'owner%d' % p, '', None) for p in range(products)], db=db)
+    model.ProductComponent.insert_many(env,
+        [('component%d' % c, 'product%d' % p, '')
+         for p in range(products) for c in range(components)], db=db)
+    released = datetime(2009, 1, 1, tzinfo=utc)
+    model.ProductVersion.insert_many(env,
+        [('1.%d' % v, 'product%d' % p, released + timedelta(days=v), '')
+         for p in range(products) for v in range(versions)], db=db)
+
+    now = to_timestamp(datetime.now(utc))
+    rows = []
+    for t in range(tickets):
+        p = t % products
+        rows.append((now, now, 'new', 'Ticket %d' % t, 'reporter',
+                     'product%d' % p, 'component%d' % (t % components),
+                     '1.%d' % (t % versions)))
+    cursor.executemany("INSERT INTO ticket (time,changetime,status,summary,reporter,"
+                       "product,product_component,product_version) "
+                       "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)", rows)
+    db.commit()
+
+
+def measure(func, repeat, setup=None):
+    """Runs `func` `repeat` times and returns timings in seconds.  `setup` is
+    run before each call, outside of the timing."""
+    timer = timeit.default_timer
+    times = []
+    for i in range(repeat):
+        if setup:
+            setup()
+        start = timer()
+        func()
+        times.append(timer() - start)
+    return {'runs': repeat, 'min': min(times), 'max': max(times),
+            'mean': sum(times) / len(times)}
+
+
+def run_benchmarks(env, repeat):
+    results = {}
+    system = ProductSystem(env)
+    reset = system.reset_catalog
+
+    # Catalog reads, both straight after a change and from the cache
+    for name, cls in (('product', model.Product),
+                      ('product_component', model.ProductComponent),
+                      ('product_version', model.ProductVersion)):
+        select = lambda: list(cls.select(env))
+        results['select_%s_cold' % name] = measure(select, repeat, setup=reset)
+        results['select_%s_warm' % name] = measure(select, repeat)
+        records = lambda: list(cls.select_records(env))
+        results['select_records_%s_warm' % name] = measure(records, repeat)
+
+    # Building the ticket fields, which includes the depselect fields on a
+    # patched Trac
+    ts = TicketSystem(env)
+    results['ticket_fields_cold'] = measure(ts.get_ticket_fields, repeat, setup=reset)
+    results['ticket_fields_warm'] = measure(ts.get_ticket_fields, repeat)
+
+    # Rendering the hidden depselect duplicates into a ticket page
+    extensions = TicketExtensions(env)
+    ticket = Ticket(env, 1)
+    template = '<html><head></head><body><div id="content"></div></body></html>'
+    def render():
+        data = {'fields': ts.get_ticket_fields(), 'ticket': ticket}
+        stream = extensions.filter_stream(Request(), 'GET', 'ticket.html',
+                                          HTML(template), data)
+        stream.render('xhtml')
+    results['filter_stream_cold'] = measure(render, repeat, setup=reset)
+    results['filter_stream_warm'] = measure(render, repeat)
+
+    # Defaulting the owner of new tickets
+    def validate():
+        new_ticket = Ticket(env)
+        new_ticket['product'] = 'product0'
+        extensions.validate_ticket(Request(), new_ticket)
+    results['validate_ticket'] = measure(validate, repeat)
+
+    # Rename cascades, renaming back and forth so every run has the same
+    # amount of work to do
+    product = model.Product(env, 'product0')
+    def rename_product():
+        if product.name == 'product0':
+            product.name = 'renamed0'
+        else:
+            product.name = 'product0'
+        product.update()
+    results['rename_product'] = measure(rename_product, repeat)
+
+    for name, cls, value in (('product_component', model.ProductComponent, 'component0'),
+                             ('product_version', model.ProductVersion, '1.0')):
+        item = cls(env, value, 'product1')
+        def rename(item=item, value=value):
+            if item.name == value:
+                item.name = 'renamed'
+            else:
+                item.name = value
+            item.update()
+        results['rename_%s' % name] = measure(rename, repeat)
+
+    return results
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--products', type='int', default=20,
+                      help='number of products [default: %default]')
+    parser.add_option('--components', type='int', default=20,
+                      help='number of components per product [default: %default]')
+    parser.add_option('--versions', type='int', default=20,
+                      help='number of versions per product [default: %default]')
+    parser.add_option('--tickets', type='int', default=10000,
+                      help='number of tickets [default: %default]')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='number of runs of each benchmark [default: %default]')
+    parser.add_option('--output', '-o', metavar='FILE',
+                      help='write results to FILE instead of standard output')
+    parser.add_option('--keep', action='store_true', default=False,
+                      help='keep the generated Trac environment')
+    options, args = parser.parse_args(args)
+
+    path = tempfile.mkdtemp(prefix='multiproduct-bench-')
+    try:
+        env_path = os.path.join(path, 'env')
+        env = create_environment(env_path)
+        populate(env, options.products, options.components, options.versions,
+                 options.tickets)
+        results = run_benchmarks(env, options.repeat)
+    finally:
+        if options.keep:
+            sys.stderr.write('Trac environment kept in %s\n' % path)
+        else:
+            shutil.rmtree(path)
+
+    report = {
+        'parameters': {'products': options.products,
+                       'components': options.components,
+                       'versions': options.versions,
+                       'tickets': options.tickets,
+                       'repeat': options.repeat},
+        'environment': {'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'trac': trac_version},
+        'results': results,
+        }
+    content = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        out = open(options.output, 'w')
+        try:
+            out.write(content + '\n')
+        finally:
+            out.close()
+    else:
+        print content
+
+
+if __name__ == '__main__':
+    main()
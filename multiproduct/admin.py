@@ -5,16 +5,53 @@
 # you should have received as part of this distribution.
 
 import re
+import sys
 
+from trac.admin import IAdminPanelProvider
 from trac.core import *
+from trac.config import IntOption
 from trac.perm import PermissionSystem
 from trac.resource import ResourceNotFound
 from trac.ticket.admin import TicketAdminPanel
+from trac.ticket.api import TicketSystem
 from trac.util.datefmt import parse_date, get_date_format_hint, get_datetime_format_hint
 from trac.util.translation import _
 from trac.web.chrome import add_script
 
 from multiproduct import model
+from multiproduct.api import ProductSystem
+from multiproduct.stats import QueryStats
+from multiproduct.summary import TicketCountSummary
+
+
+def _in_unit_of_work(render):
+    """Wraps the render method of an admin panel so that everything a POST
+    request changes is committed in one transaction, with one reset of the
+    catalog.  Panels redirect once they are done, so the transaction is
+    committed before the redirect is sent, which makes sure the page redirected
+    to shows the changes, and that a failed commit is reported as an error."""
+    def wrapper(self, req, *args):
+        if req.method != 'POST':
+            return render(self, req, *args)
+        uow = ProductSystem(self.env).unit_of_work()
+        unit = uow.__enter__()
+        redirect = req.redirect
+        def commit_and_redirect(*redirect_args, **kwargs):
+            if unit.outermost:
+                unit.commit()
+            redirect(*redirect_args, **kwargs)
+        req.redirect = commit_and_redirect
+        exc_info = (None, None, None)
+        try:
+            try:
+                return render(self, req, *args)
+            except:
+                exc_info = sys.exc_info()
+                raise
+        finally:
+            del req.redirect
+            uow.__exit__(*exc_info)
+    return wrapper
 
 
 class ProductAdminPanel(TicketAdminPanel):
@@ -23,6 +60,11 @@ class ProductAdminPanel(TicketAdminPanel):
     _type = 'products'
     _label = ('Product', 'Products')
 
+    def __init__(self):
+        # Cached list of valid owners, and what it was worked out from
+        self._owners = None
+        self._owners_key = None
+
     # TicketAdminPanel methods
 
     def _render_admin_panel(self, req, cat, page, product):
@@ -33,14 +75,19 @@ class ProductAdminPanel(TicketAdminPanel):
                 if req.args.get('save'):
                     prod.name = req.args.get('name')
                     prod.owner = req.args.get('owner')
+                    prod.parent = req.args.get('parent') or None
                     prod.description = req.args.get('description')
                     prod.update()
                     req.redirect(req.href.admin(cat, page))
                 elif req.args.get('cancel'):
                     req.redirect(req.href.admin(cat, page))
 
+            # A product can't be moved below itself
+            catalog = ProductSystem(self.env).get_catalog()
+            subtree = set(catalog.get_subtree(prod.name))
             add_script(req, 'common/js/wikitoolbar.js')
-            data = {'view': 'detail', 'field': prod}
+            data = {'view': 'detail', 'field': prod,
+                    'parents': [p for p in catalog.products if p.name not in subtree]}
 
         else:
             if req.method == 'POST':
@@ -54,6 +101,7 @@ class ProductAdminPanel(TicketAdminPanel):
                         prod.name = name
                         if req.args.get('owner'):
                             prod.owner = req.args.get('owner')
+                        prod.parent = req.args.get('parent') or None
                         prod.insert()
                         req.redirect(req.href.admin(cat, page))
                     else:
@@ -66,11 +114,7 @@ class ProductAdminPanel(TicketAdminPanel):
                         raise TracError(_('No product selected'))
                     if not isinstance(sel, list):
                         sel = [sel]
-                    db = self.env.get_db_cnx()
-                    for name in sel:
-                        prod = model.Product(self.env, name, db=db)
-                        prod.delete(db=db)
-                    db.commit()
+                    model.Product.delete_many(self.env, sel)
                     req.redirect(req.href.admin(cat, page))
 
                 # Set default product
@@ -83,25 +127,98 @@ class ProductAdminPanel(TicketAdminPanel):
                         req.redirect(req.href.admin(cat, page))
 
             default = self.config.get('ticket', 'default_product')
+            products = list(model.Product.select_records(self.env))
             data = {'view': 'list',
-                    'products': list(model.Product.select(self.env)),
+                    'products': products,
+                    'parents': products,
+                    'counts': TicketCountSummary(self.env).get_product_counts(),
                     'default': default}
 
         if self.config.getbool('ticket', 'restrict_owner'):
-            perm = PermissionSystem(self.env)
-            def valid_owner(username):
-                return perm.get_user_permissions(username).get('TICKET_MODIFY')
-            data['owners'] = [username for username, name, email
-                              in self.env.get_known_users()
-                              if valid_owner(username)]
-            data['owners'].insert(0, '')
-            data['owners'].sort()
+            data['owners'] = [''] + self._get_valid_owners()
         else:
             data['owners'] = None
 
         data['label_singular'] = self._label[0]
         data['label_plural'] = self._label[1]
         return 'admin_products.html', data
+    _render_admin_panel = _in_unit_of_work(_render_admin_panel)
+
+    # Internal methods
+
+    def _get_valid_owners(self):
+        """Returns the sorted list of known users that have the TICKET_MODIFY
+        permission.
+
+        Rather than asking the permission system about each user in turn, the
+        permission table is read once and the users who hold TICKET_MODIFY,
+        directly, through a meta-permission or through group membership, are
+        worked out for everybody in a single pass.  The result is kept until
+        the permission table or the set of known users changes."""
+        perm = PermissionSystem(self.env)
+        grants = perm.get_all_permissions()
+
+        db = self.env.get_db_cnx()
+        cursor = QueryStats(self.env).cursor(db)
+        # Users that are added have the latest visit, so between the count and
+        # the latest visit any change to the known users is noticed, at the
+        # price of recomputing after a visit, without reading every session
+        cursor.execute("SELECT COUNT(*),MAX(last_visit) FROM session "
+                       "WHERE authenticated=1")
+        key = (sorted(grants), cursor.fetchone())
+        if self._owners is not None and self._owners_key == key:
+            return self._owners
+
+        # Find every action that implies TICKET_MODIFY
+        meta = {}
+        for requestor in perm.requestors:
+            for action in requestor.get_permission_actions() or []:
+                if isinstance(action, tuple):
+                    meta.setdefault(action[0], []).extend(action[1])
+        def implies(action, seen):
+            if action == 'TICKET_MODIFY':
+                return True
+            seen.add(action)
+            for child in meta.get(action, []):
+                if child not in seen and implies(child, seen):
+                    return True
+            return False
+        granting = set([action for subject, action in grants
+                        if action.isupper() and implies(action, set())])
+
+        # Find every subject that holds one of those actions, following group
+        # memberships backwards until no more members are found
+        holders = set([subject for subject, action in grants if action in granting])
+        members = {}
+        for subject, action in grants:
+            if not action.isupper():
+                members.setdefault(action, []).append(subject)
+        pending = list(holders)
+        while pending:
+            for subject in members.get(pending.pop(), []):
+                if subject not in holders:
+                    holders.add(subject)
+                    pending.append(subject)
+
+        # Users can also get permissions from groups they are put in by group
+        # providers, such as 'authenticated'
+        providers = getattr(perm.store, 'group_providers', [])
+        def valid_owner(username):
+            if username in holders:
+                return True
+            for provider in providers:
+                for group in provider.get_permission_groups(username) or []:
+                    if group in holders:
+                        return True
+            return False
+        owners = [username for username, name, email
+                  in self.env.get_known_users(db)
+                  if valid_owner(username)]
+        owners.sort()
+
+        self._owners = owners
+        self._owners_key = key
+        return owners
 
 
 class ProductComponentAdminPanel(TicketAdminPanel):
@@ -110,6 +227,10 @@ class ProductComponentAdminPanel(TicketAdminPanel):
     _type = 'productcomponents'
     _label = ('Product Component', 'Product Components')
 
+    page_size = IntOption('multiproduct', 'admin_page_size', 100,
+        """Number of product components or versions listed per page in the
+        admin panels.""")
+
     # TicketAdminPanel methods
 
     def _render_admin_panel(self, req, cat, page, productcomponent):
@@ -161,33 +282,48 @@ class ProductComponentAdminPanel(TicketAdminPanel):
                         raise TracError(_('No product component selected'))
                     if not isinstance(sel, list):
                         sel = [sel]
-                    db = self.env.get_db_cnx()
-                    for name in sel:
-                        prodcomp = model.ProductComponent(self.env, name, parent, db=db)
-                        prodcomp.delete(db=db)
-                    db.commit()
+                    model.ProductComponent.delete_many(self.env, sel, parent)
                     req.redirect(req.href.admin(cat, page, parent))
 
                 # Change selected parent product
                 elif req.args.get('parent'):
                     req.redirect(req.href.admin(cat, page, req.args.get('parent')))
 
-            products = list(model.Product.select(self.env))
+            products = list(model.Product.select_records(self.env))
             if productcomponent:
                 parent = productcomponent # Catches redirects
             else:
                 parent = products[0].name or None # Just use the first in the list as default
 
+            # Read one more than a page to find out whether there is a next one
+            after = req.args.get('after')
+            name_filter = req.args.get('q')
+            prodcomps = list(model.ProductComponent.select_page(self.env, parent,
+                                                                after=after,
+                                                                limit=self.page_size + 1,
+                                                                name_filter=name_filter))
+            next_href = None
+            if len(prodcomps) > self.page_size:
+                del prodcomps[self.page_size:]
+                next_href = req.href.admin(cat, page, parent, after=prodcomps[-1].name,
+                                           q=name_filter)
+            first_href = after and req.href.admin(cat, page, parent, q=name_filter) or None
+
             data = {
                 'view': 'list',
                 'products': products,
-                'productcomponents': list(model.ProductComponent.select(self.env, parent=parent)),
+                'productcomponents': prodcomps,
+                'counts': TicketCountSummary(self.env).get_component_counts(parent),
                 'parent': parent,
+                'filter': name_filter,
+                'first_href': first_href,
+                'next_href': next_href,
                 }
 
         data['label_singular'] = self._label[0]
         data['label_plural'] = self._label[1]
         return 'admin_productcomponents.html', data
+    _render_admin_panel = _in_unit_of_work(_render_admin_panel)
 
 
 class ProductVersionAdminPanel(TicketAdminPanel):
@@ -196,6 +332,8 @@ class ProductVersionAdminPanel(TicketAdminPanel):
     _type = 'productversions'
     _label = ('Product Version', 'Product Versions')
 
+    page_size = ProductComponentAdminPanel.page_size
+
     # TicketAdminPanel methods
 
     def _render_admin_panel(self, req, cat, page, productversion):
@@ -250,31 +388,130 @@ class ProductVersionAdminPanel(TicketAdminPanel):
                         raise TracError(_('No product version selected'))
                     if not isinstance(sel, list):
                         sel = [sel]
-                    db = self.env.get_db_cnx()
-                    for name in sel:
-                        prodver = model.ProductVersion(self.env, name, parent, db=db)
-                        prodver.delete(db=db)
-                    db.commit()
+                    model.ProductVersion.delete_many(self.env, sel, parent)
                     req.redirect(req.href.admin(cat, page, parent))
 
                 # Change selected parent product
                 elif req.args.get('parent'):
                     req.redirect(req.href.admin(cat, page, req.args.get('parent')))
 
-            products = list(model.Product.select(self.env))
+            products = list(model.Product.select_records(self.env))
             if productversion:
                 parent = productversion # Catches redirects
             else:
                 parent = products[0].name or None # Just use the first in the list as default
 
+            # Read one more than a page to find out whether there is a next one
+            after = req.args.get('after')
+            name_filter = req.args.get('q')
+            prodvers = list(model.ProductVersion.select_page(self.env, parent,
+                                                             after=after,
+                                                             limit=self.page_size + 1,
+                                                             name_filter=name_filter))
+            next_href = None
+            if len(prodvers) > self.page_size:
+                del prodvers[self.page_size:]
+                next_href = req.href.admin(cat, page, parent, after=prodvers[-1].sort_key,
+                                           q=name_filter)
+            first_href = after and req.href.admin(cat, page, parent, q=name_filter) or None
+
             data = {
                 'view': 'list',
                 'products': products,
-                'productversions': list(model.ProductVersion.select(self.env, parent=parent)),
+                'productversions': prodvers,
+                'counts': TicketCountSummary(self.env).get_version_counts(parent),
                 'parent': parent,
+                'filter': name_filter,
+                'first_href': first_href,
+                'next_href': next_href,
                 }
 
         data['datetime_hint'] = get_datetime_format_hint()
         data['label_singular'] = self._label[0]
         data['label_plural'] = self._label[1]
         return 'admin_productversions.html', data
+    _render_admin_panel = _in_unit_of_work(_render_admin_panel)
+
+
+class DepselectOptionAdminPanel(Component):
+    """Provides an admin panel for each depselect field declared in
+    trac.ini."""
+
+    implements(IAdminPanelProvider)
+
+    # IAdminPanelProvider methods
+
+    def get_admin_panels(self, req):
+        if req.perm.has_permission('TICKET_ADMIN'):
+            for field in ProductSystem(self.env).get_depselect_fields():
+                if field['custom']:
+                    yield ('ticket', 'Ticket System', field['name'], field['label'])
+
+    def render_admin_panel(self, req, cat, page, parent):
+        req.perm.require('TICKET_ADMIN')
+        for field in ProductSystem(self.env).get_depselect_fields():
+            if field['name'] == page:
+                break
+        else:
+            raise TracError(_('No depselect field named %s') % page)
+
+        if req.method == 'POST':
+            # Add option
+            if req.args.get('add') and req.args.get('name') and req.args.get('parent'):
+                name = req.args.get('name')
+                parent = req.args.get('parent')
+                try:
+                    model.DepselectOption(self.env, page, name=name, parent=parent)
+                except ResourceNotFound:
+                    option = model.DepselectOption(self.env, page)
+                    option.name = name
+                    option.parent = parent
+                    option.insert()
+                    req.redirect(req.href.admin(cat, page, option.parent))
+                else:
+                    raise TracError(_('%s %s already exists.') % (field['label'], name))
+
+            # Remove options
+            elif req.args.get('remove'):
+                sel = req.args.get('sel')
+                parent = req.args.get('parent')
+                if not sel:
+                    raise TracError(_('No %s selected') % field['label'])
+                if not isinstance(sel, list):
+                    sel = [sel]
+                model.DepselectOption.delete_many(self.env, page, sel, parent)
+                req.redirect(req.href.admin(cat, page, parent))
+
+            # Change selected parent value
+            elif req.args.get('parent'):
+                req.redirect(req.href.admin(cat, page, req.args.get('parent')))
+
+        parents = self._get_parent_values(field['parent'])
+        if not parent:
+            parent = parents and parents[0] or None # Just use the first in the list as default
+
+        data = {'view': 'list',
+                'parents': parents,
+                'parent': parent,
+                'parent_label': field['parent'].replace('_', ' ').title(),
+                'options': list(model.DepselectOption.select_records(self.env, page,
+                                                                     parent=parent)),
+                'label_singular': field['label'],
+                'label_plural': field['label']}
+        return 'admin_depselect.html', data
+    render_admin_panel = _in_unit_of_work(render_admin_panel)
+
+    # Internal methods
+
+    def _get_parent_values(self, name):
+        for field in TicketSystem(self.env).get_ticket_fields():
+            if field['name'] == name:
+                if field['type'] == 'depselect':
+                    values = []
+                    for option, parent in field['options']:
+                        if option not in values:
+                            values.append(option)
+                    return values
+                return list(field.get('options', []))
+        return []
+
@@ -0,0 +1,599 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import os
+import threading
+import time
+from datetime import datetime
+from operator import itemgetter
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from trac.core import *
+from trac.config import Option
+from trac.ticket.api import TicketSystem
+from trac.util.datefmt import utc, to_timestamp
+from trac.web.api import IRequestFilter, RequestDone
+
+from multiproduct.stats import QueryStats
+
+try:
+    from trac.admin.api import IAdminCommandProvider
+except ImportError:
+    # Trac 0.11 can't be extended with trac-admin commands, there they are
+    # only available through the multiproduct-admin script
+    class IAdminCommandProvider(Interface):
+        """Stand-in for the interface of the same name in later versions of
+        Trac."""
+
+        def get_admin_commands():
+            """Return a list of available admin commands."""
+
+__all__ = ['IAdminCommandProvider', 'ProductFieldProvider', 'ProductSystem',
+           'UnitOfWork']
+
+
+# Bumped whenever the content of catalog snapshots changes, so that snapshots
+# written by older versions of the plug-in are ignored
+SNAPSHOT_FORMAT = 3
+
+
+class ProductRecord(tuple):
+    """Read-only product, as held by the catalog."""
+
+    __slots__ = ()
+
+    name = property(itemgetter(0))
+    owner = property(itemgetter(1))
+    description = property(itemgetter(2))
+    parent = property(itemgetter(3))
+    path = property(itemgetter(4))
+
+    def depth(self):
+        # Escaped slashes in the path don't separate names
+        return self[4].replace('\\\\', '').replace('\\/', '').count('/') - 1
+    depth = property(depth)
+
+
+class ProductComponentRecord(tuple):
+    """Read-only product component, as held by the catalog."""
+
+    __slots__ = ()
+
+    name = property(itemgetter(0))
+    parent = property(itemgetter(1))
+    description = property(itemgetter(2))
+
+
+class ProductVersionRecord(tuple):
+    """Read-only product version, as held by the catalog."""
+
+    __slots__ = ()
+
+    name = property(itemgetter(0))
+    parent = property(itemgetter(1))
+    time = property(itemgetter(2))
+    description = property(itemgetter(3))
+
+
+class DepselectOptionRecord(tuple):
+    """Read-only option of a depselect field declared in trac.ini, as held by
+    the catalog."""
+
+    __slots__ = ()
+
+    field = property(itemgetter(0))
+    parent = property(itemgetter(1))
+    name = property(itemgetter(2))
+
+
+class Catalog(object):
+    """Read-only snapshot of the product, product component, product version
+    and depselect option tables."""
+
+    def __init__(self, revision, products, components, versions, renames,
+                 options=()):
+        self.revision = revision
+
+        # Rows are kept as records, in the order the model select methods
+        # return them
+        self.products = products
+        self.components = components
+        self.versions = versions
+
+        self.components_by_parent = {}
+        for row in components:
+            self.components_by_parent.setdefault(row[1], []).append(row)
+        self.versions_by_parent = {}
+        for row in versions:
+            self.versions_by_parent.setdefault(row[1], []).append(row)
+
+        # Owner of each product, for defaulting ticket owners
+        self.owners = dict([(row[0], row[1]) for row in products])
+
+        # Products directly below each product, None for the top level
+        self.children = {}
+        for row in products:
+            self.children.setdefault(row[3], []).append(row[0])
+
+        # Products whose tickets are still being renamed, old name -> new name,
+        # and the reverse
+        self.renames = renames
+        self.aliases = {}
+        for old_name, new_name in renames.items():
+            self.aliases.setdefault(new_name, []).append(old_name)
+
+        # Rows of each depselect field, keyed by the value of the parent field.
+        # Options of the fields declared in trac.ini are (name, parent) rows,
+        # ordered by field, parent and name.
+        self.options = options
+        self.depselects = {'product_component': self.components_by_parent,
+                           'product_version': self.versions_by_parent}
+        for field, parent, name in options:
+            self.depselects.setdefault(field, {}).setdefault(parent, []) \
+                .append((name, parent))
+
+        # Bare (name, parent) options of each depselect field, for callers that
+        # need nothing else
+        self._options = {
+            'product_component': [(row[0], row[1]) for row in components],
+            'product_version': [(row[0], row[1]) for row in versions],
+            }
+        for field, parent, name in options:
+            self._options.setdefault(field, []).append((name, parent))
+
+    def get_options(self, field, parent):
+        """Returns the names of the options of a depselect field that belong to
+        the given parent value."""
+        return [row[0] for row in self.depselects.get(field, {}).get(parent, [])]
+
+    def get_options_list(self, field):
+        """Returns all options of a depselect field as (name, parent) tuples."""
+        return list(self._options.get(field, []))
+
+    def get_subtree(self, name):
+        """Returns the names of a product and of all products below it."""
+        names = [name]
+        for name in names:
+            names.extend(self.children.get(name, []))
+        return names
+
+    def get_modified(self):
+        """Returns the time the catalog was last changed, derived from the
+        revision."""
+        return datetime.fromtimestamp(self.revision / 1000000.0, utc)
+
+
+class UnitOfWork(object):
+    """Groups the model writes of one thread into a single transaction.
+
+    While a unit of work is active, model objects read and write through its
+    connection, and the catalog revision is bumped, the transaction committed
+    and the catalog reset only once, when the unit is committed.  Bulk model
+    methods given the unit's connection are looked after the same way.  The
+    cached catalog is not reset until then, so it doesn't show the unit's own
+    changes.
+
+    Use it as a context manager, which commits if the block finishes or ends
+    with `RequestDone` and rolls back on any other exception:
+
+        with ProductSystem(env).unit_of_work():
+            product = Product(env, 'foo')
+            product.owner = 'bar'
+            product.update()
+
+    Without the with statement, the same is spelt:
+
+        uow = ProductSystem(env).unit_of_work()
+        uow.__enter__()
+        exc_info = (None, None, None)
+        try:
+            try:
+                ...
+            except:
+                exc_info = sys.exc_info()
+                raise
+        finally:
+            uow.__exit__(*exc_info)
+
+    Units of work may be nested, in which case the inner ones join the
+    outermost one, and only that one opens a connection and commits."""
+
+    def __init__(self, system):
+        self.system = system
+        self.db = None
+        self.changed = False
+        self._depth = 0
+
+    outermost = property(fget=lambda self: self._depth == 1)
+
+    def commit(self):
+        if self.changed:
+            self.system.update_revision(self.db)
+        self.db.commit()
+        if self.changed:
+            self.changed = False
+            self.system.reset_catalog()
+
+    def rollback(self):
+        self.db.rollback()
+        self.changed = False
+
+    def __enter__(self):
+        local = self.system._local
+        unit = getattr(local, 'unit', None)
+        if unit is None:
+            self.db = self.system.env.get_db_cnx()
+            local.unit = unit = self
+        unit._depth += 1
+        return unit
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        local = self.system._local
+        unit = local.unit
+        unit._depth -= 1
+        if unit._depth:
+            return False
+        local.unit = None
+        if exc_type is None or issubclass(exc_type, RequestDone):
+            unit.commit()
+        else:
+            unit.rollback()
+        return False
+
+
+class ProductSystem(Component):
+    """Keeps a process-wide cache of the product catalog.
+
+    The cache is shared between processes by way of a catalog revision stored
+    in the `system` table: every write to the catalog bumps the revision in
+    the same transaction, and each request checks it to find out whether
+    another process has changed the catalog.
+
+    Each catalog loaded from the database is also written to a snapshot file
+    in the environment, which new processes load instead of the tables for as
+    long as its revision is current."""
+
+    implements(IRequestFilter)
+
+    snapshot = Option('multiproduct', 'catalog_snapshot', 'db/multiproduct-catalog.json',
+        """File in which a copy of the product catalog is kept for new
+        processes to start from, relative to the environment directory.  Leave
+        empty to always load the catalog from the database.""")
+
+    def __init__(self):
+        self._catalog = None
+        self._catalog_generation = None
+        self._generation = 0
+        self._catalog_lock = threading.Lock()
+        self._local = threading.local()
+
+    def unit_of_work(self):
+        """Returns a new `UnitOfWork`, to be used as a context manager.  If
+        this thread is already in one, entering it joins that one."""
+        return UnitOfWork(self)
+
+    def get_db(self, db=None):
+        """Returns `db` if given, or else the connection of the current unit of
+        work, or else a new connection."""
+        if db:
+            return db
+        unit = getattr(self._local, 'unit', None)
+        if unit is not None:
+            return unit.db
+        return self.env.get_db_cnx()
+
+    def begin_write(self, db=None):
+        """Returns the connection for a write to the catalog, and whether the
+        writer has to commit it.  Must be followed by `end_write`."""
+        # Until then, catalogs loaded by this thread may see the write
+        self._local.writes = getattr(self._local, 'writes', 0) + 1
+        if db:
+            return db, False
+        unit = getattr(self._local, 'unit', None)
+        if unit is not None:
+            return unit.db, False
+        return self.env.get_db_cnx(), True
+
+    def end_write(self, db, handle_ta, bulk=False):
+        """Finishes a write to the catalog made through `db`: bumps the
+        revision, commits if `handle_ta` and resets the catalog.  Within a unit
+        of work this is left to the unit, and `bulk` writes to a connection of
+        the caller's are left to the caller."""
+        self._local.writes -= 1
+        unit = getattr(self._local, 'unit', None)
+        if unit is not None and unit.db is db:
+            unit.changed = True
+            return
+        if bulk and not handle_ta:
+            return
+        self.update_revision(db)
+        if handle_ta:
+            db.commit()
+        self.reset_catalog()
+
+    def get_catalog(self, db=None):
+        """Returns the cached catalog, reloading it from the database if it
+        has been reset since it was last loaded.
+
+        A catalog loaded in the middle of a write, or within a unit of work,
+        may hold changes that are not committed yet and could still be rolled
+        back, so it is neither cached nor written to the snapshot."""
+        catalog = self._catalog
+        if catalog is None or self._catalog_generation != self._generation:
+            if getattr(self._local, 'writes', 0) or \
+                    getattr(self._local, 'unit', None) is not None:
+                return self._load_catalog(self.get_db(db), shared=False)
+            self._catalog_lock.acquire()
+            try:
+                generation = self._generation
+                if self._catalog is None or self._catalog_generation != generation:
+                    self._catalog = self._load_catalog(db)
+                    self._catalog_generation = generation
+                catalog = self._catalog
+            finally:
+                self._catalog_lock.release()
+        return catalog
+
+    def reset_catalog(self):
+        """Marks the cached catalog and ticket fields as stale.  Must be called
+        whenever one of the catalog tables is written to."""
+        self._catalog_lock.acquire()
+        try:
+            self._generation += 1
+        finally:
+            self._catalog_lock.release()
+        TicketSystem(self.env).reset_ticket_fields()
+
+    def get_depselect_fields(self):
+        """Returns the depselect fields as a list of dictionaries with the keys
+        `name`, `label`, `parent` and `custom`.
+
+        Product Component and Product Version are always there.  Further
+        fields are declared in the `[multiproduct-depselect]` section of
+        trac.ini, where each option names a field and its value the field it
+        depends on, and are stored like custom ticket fields:
+
+            [multiproduct-depselect]
+            platform = product
+            platform.label = Platform
+            release_train = platform
+            release_train.label = Release Train
+            release_train.order = 2
+
+        Their options are kept in the depselect option table."""
+        fields = [{'name': 'product_component', 'label': 'Product Component',
+                   'parent': 'product', 'custom': False},
+                  {'name': 'product_version', 'label': 'Product Version',
+                   'parent': 'product', 'custom': False}]
+        config = self.config['multiproduct-depselect']
+        custom = []
+        for name, parent in config.options():
+            if '.' in name or name in ('product_component', 'product_version'):
+                continue
+            custom.append({'name': name, 'parent': parent, 'custom': True,
+                           'label': config.get(name + '.label') or
+                                    ' '.join(name.split('_')).title(),
+                           'order': config.getint(name + '.order', 0)})
+        custom.sort(key=lambda field: (field['order'], field['name']))
+        for field in custom:
+            del field['order']
+        return fields + custom
+
+    def get_revision(self, db=None):
+        """Returns the current catalog revision from the database."""
+        if not db:
+            db = self.env.get_db_cnx()
+        cursor = QueryStats(self.env).cursor(db)
+        cursor.execute("SELECT value FROM system WHERE name='multiproduct_catalog_rev'")
+        row = cursor.fetchone()
+        return row and int(row[0]) or 0
+
+    def update_revision(self, db):
+        """Bumps the catalog revision.  This does not commit, it is meant to
+        be called in the same transaction as the change to the catalog.
+
+        The revision is a timestamp in microseconds, so that it can double as
+        the catalog's modification time, but is always incremented even if the
+        clock goes backwards."""
+        cursor = QueryStats(self.env).cursor(db)
+        cursor.execute("SELECT value FROM system WHERE name='multiproduct_catalog_rev'")
+        row = cursor.fetchone()
+        revision = int(time.time() * 1000000)
+        if row:
+            revision = max(revision, int(row[0]) + 1)
+            cursor.execute("UPDATE system SET value=%s WHERE name='multiproduct_catalog_rev'",
+                           (str(revision),))
+        else:
+            cursor.execute("INSERT INTO system (name,value) VALUES ('multiproduct_catalog_rev',%s)",
+                           (str(revision),))
+        return revision
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        # A write that failed half way never got to end_write, and has been
+        # rolled back since
+        self._local.writes = 0
+        catalog = self._catalog
+        if catalog is not None and self._catalog_generation == self._generation:
+            revision = self.get_revision()
+            if catalog.revision != revision:
+                self.log.debug('Product catalog changed from revision %s to %s',
+                               catalog.revision, revision)
+                self.reset_catalog()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # Internal methods
+
+    def _load_catalog(self, db=None, shared=True):
+        """Loads the catalog from the snapshot or the tables.  Unless `shared`,
+        the snapshot is left alone as the tables may not be committed."""
+        if not db:
+            db = self.env.get_db_cnx()
+        revision = self.get_revision(db)
+        if shared:
+            catalog = self._read_snapshot(revision)
+            if catalog is not None:
+                return catalog
+
+        self.log.debug('Loading product catalog')
+        cursor = QueryStats(self.env).cursor(db)
+
+        # Ordered by path, products follow their parent
+        cursor.execute("SELECT name,owner,description,parent,path FROM multiproduct_product "
+                       "ORDER BY path")
+        products = [ProductRecord((name, owner or None, description or '', parent or None,
+                                   path))
+                    for name, owner, description, parent, path in cursor]
+
+        cursor.execute("SELECT name,parent,description FROM multiproduct_product_component "
+                       "ORDER BY parent,name")
+        components = [ProductComponentRecord((name, parent, description or ''))
+                      for name, parent, description in cursor]
+
+        cursor.execute("SELECT name,parent,time,description FROM multiproduct_product_version "
+                       "ORDER BY sort_key DESC")
+        versions = [ProductVersionRecord((name, parent,
+                                          time and datetime.fromtimestamp(int(time), utc) or None,
+                                          description or ''))
+                    for name, parent, time, description in cursor]
+
+        cursor.execute("SELECT old_name,new_name FROM multiproduct_product_rename")
+        renames = dict(cursor.fetchall())
+
+        # The options of all fields declared in trac.ini, in key order
+        cursor.execute("SELECT field,parent,name FROM multiproduct_depselect_option "
+                       "ORDER BY field,parent,name")
+        options = [DepselectOptionRecord(row) for row in cursor]
+
+        catalog = Catalog(revision, products, components, versions, renames, options)
+        if shared:
+            self._write_snapshot(catalog)
+        return catalog
+
+    def _get_snapshot_path(self):
+        if self.snapshot:
+            return os.path.join(self.env.path, self.snapshot)
+
+    def _read_snapshot(self, revision):
+        """Returns the catalog held by the snapshot file, or None if there is
+        no snapshot of the given revision."""
+        path = self._get_snapshot_path()
+        if not path or not os.path.isfile(path):
+            return None
+        try:
+            f = open(path, 'rb')
+            try:
+                snapshot = json.load(f)
+            finally:
+                f.close()
+            if snapshot.get('format') != SNAPSHOT_FORMAT or \
+                    snapshot.get('revision') != revision:
+                return None
+            self.log.debug('Loading product catalog from %s', path)
+            return Catalog(revision,
+                [ProductRecord(row) for row in snapshot['products']],
+                [ProductComponentRecord(row) for row in snapshot['components']],
+                [ProductVersionRecord((name, parent,
+                                       time and datetime.fromtimestamp(time, utc) or None,
+                                       description))
+                 for name, parent, time, description in snapshot['versions']],
+                snapshot['renames'],
+                [DepselectOptionRecord(row) for row in snapshot['options']])
+        except (IOError, ValueError, KeyError, TypeError), e:
+            self.log.warning('Ignoring product catalog snapshot %s: %s', path, e)
+            return None
+
+    def _write_snapshot(self, catalog):
+        """Writes the catalog to the snapshot file.  The file is replaced in
+        one step so that other processes never read half of it."""
+        path = self._get_snapshot_path()
+        if not path:
+            return
+        content = json.dumps({
+            'format': SNAPSHOT_FORMAT,
+            'revision': catalog.revision,
+            'products': catalog.products,
+            'components': catalog.components,
+            'versions': [(name, parent, time and to_timestamp(time) or None, description)
+                         for name, parent, time, description in catalog.versions],
+            'renames': catalog.renames,
+            'options': catalog.options,
+            }, separators=(',', ':'))
+        temp_path = '%s.%d.%d' % (path, os.getpid(), id(threading.currentThread()))
+        try:
+            f = open(temp_path, 'wb')
+            try:
+                f.write(content)
+            finally:
+                f.close()
+            try:
+                os.rename(temp_path, path)
+            except OSError:
+                # Windows won't rename over an existing file
+                os.remove(path)
+                os.rename(temp_path, path)
+        except (IOError, OSError), e:
+            self.log.warning('Could not write product catalog snapshot %s: %s', path, e)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+class ProductFieldProvider(Component):
+    """Provides the ready-made ticket field dictionaries of the Product field
+    and the depselect fields, for the patched `TicketSystem` to add to its
+    fields.
+
+    The dictionaries are only built once per catalog, so rebuilding the
+    ticket fields for reasons that have nothing to do with products, such as
+    a new milestone, costs neither a query nor a copy of the options."""
+
+    def __init__(self):
+        # Catalog and the fields built from it, replaced in one assignment
+        self._fields = (None, None)
+
+    def get_ticket_fields(self, db=None):
+        """Returns the field dictionaries, which are shared and must not be
+        changed."""
+        catalog = ProductSystem(self.env).get_catalog(db)
+        fields_catalog, fields = self._fields
+        if fields_catalog is not catalog:
+            # Two threads may build the fields at once, which is harmless
+            fields = self._build_fields(catalog)
+            self._fields = (catalog, fields)
+        return fields
+
+    # Internal methods
+
+    def _build_fields(self, catalog):
+        fields = []
+        options = [row[0] for row in catalog.products]
+        # Fields without possible values are treated as if they didn't exist
+        if options:
+            fields.append({'name': 'product', 'type': 'select', 'label': 'Product',
+                           'value': self.config.get('ticket', 'default_product'),
+                           'options': options})
+
+        for depselect in ProductSystem(self.env).get_depselect_fields():
+            options = catalog.get_options_list(depselect['name'])
+            if not options:
+                continue
+            # depselects don't have defaults because it would depend what the
+            # default for the parent select would be
+            field = {'name': depselect['name'], 'type': 'depselect',
+                     'label': depselect['label'], 'options': options,
+                     'parent': depselect['parent'], 'optional': True}
+            if depselect['custom']:
+                field['custom'] = True
+            fields.append(field)
+        return fields
+
@@ -0,0 +1,180 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import threading
+
+from trac.core import *
+from trac.config import BoolOption, IntOption
+from trac.db import Table, Column
+from trac.web.api import IRequestFilter
+
+from multiproduct.api import ProductSystem
+from multiproduct.stats import QueryStats
+from multiproduct.summary import TicketCountSummary
+
+__all__ = ['RenameCascade']
+
+
+schema = [
+    Table('multiproduct_product_rename', key='old_name')[
+        Column('old_name'),
+        Column('new_name'),
+        Column('next_id', type='int'),
+        Column('max_id', type='int'),
+        ]
+    ]
+
+
+class RenameCascade(Component):
+    """Cascades product renames to tickets in the background.
+
+    Instead of rewriting every ticket of a renamed product in the transaction
+    that renames it, a rename job is recorded and tickets are rewritten by a
+    worker thread in batches of ticket ids, committing after each batch.  The
+    progress of each job is kept in the database so that it can be resumed by
+    any process if the one running it dies.  Until a job is finished, the old
+    product name is treated as an alias of the new one."""
+
+    implements(IRequestFilter)
+
+    deferred = BoolOption('multiproduct', 'deferred_rename_cascade', 'false',
+        """Whether renaming a product should rewrite the product field of its
+        tickets in the background rather than immediately.  Enable this for
+        large ticket tables, where the immediate rename would lock the
+        database for a long time.""")
+
+    batch_size = IntOption('multiproduct', 'rename_batch_size', 1000,
+        """Range of ticket ids rewritten per transaction by a background
+        product rename.""")
+
+    def __init__(self):
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def queue_rename(self, old_name, new_name, db):
+        """Records a job to rename a product in the tickets.  This does not
+        commit, it is meant to be called in the same transaction as the change
+        to the product."""
+        cursor = QueryStats(self.env).cursor(db)
+
+        # A job involving either name can't be combined with this one without
+        # confusing which tickets belong to which product, so finish it now
+        cursor.execute("SELECT old_name,new_name FROM multiproduct_product_rename "
+                       "WHERE old_name=%s OR old_name=%s", (old_name, new_name))
+        for job_old, job_new in cursor.fetchall():
+            self.log.info('Finishing rename of product %s to %s', job_old, job_new)
+            cursor.execute("UPDATE ticket SET product=%s WHERE product=%s",
+                           (job_new, job_old))
+            cursor.execute("DELETE FROM multiproduct_product_rename WHERE old_name=%s",
+                           (job_old,))
+            TicketCountSummary(self.env).recount(db, [job_old, job_new])
+
+        # Jobs still renaming to the old name now have to rename to the new one
+        cursor.execute("UPDATE multiproduct_product_rename SET new_name=%s "
+                       "WHERE new_name=%s", (new_name, old_name))
+
+        cursor.execute("SELECT MAX(id) FROM ticket")
+        max_id = cursor.fetchone()[0] or 0
+        self.log.info('Queueing rename of product %s to %s for tickets up to #%d',
+                      old_name, new_name, max_id)
+        cursor.execute("INSERT INTO multiproduct_product_rename "
+                       "(old_name,new_name,next_id,max_id) VALUES (%s,%s,%s,%s)",
+                       (old_name, new_name, 0, max_id))
+
+    def run_pending(self):
+        """Works through all pending rename jobs, returning when there are none
+        left.  Safe to run from several processes at once."""
+        while True:
+            db = self.env.get_db_cnx()
+            cursor = QueryStats(self.env).cursor(db)
+            cursor.execute("SELECT old_name FROM multiproduct_product_rename")
+            jobs = [old_name for old_name, in cursor]
+            if not jobs:
+                return
+            for old_name in jobs:
+                while self._run_batch(old_name):
+                    pass
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        catalog = ProductSystem(self.env).get_catalog()
+        if catalog.renames:
+            self._start_worker()
+            if req.path_info == '/query' and 'product' in req.args:
+                self._add_aliases(req, catalog)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # Internal methods
+
+    def _start_worker(self):
+        self._worker_lock.acquire()
+        try:
+            if self._worker is None or not self._worker.isAlive():
+                self._worker = threading.Thread(target=self._run_worker,
+                                                name='multiproduct-rename')
+                self._worker.setDaemon(True)
+                self._worker.start()
+        finally:
+            self._worker_lock.release()
+
+    def _run_worker(self):
+        try:
+            self.run_pending()
+        except Exception, e:
+            # The job will be picked up again on a later request
+            self.log.error('Product rename failed: %s', e, exc_info=True)
+
+    def _run_batch(self, old_name):
+        """Rewrites the next batch of tickets for a rename job and commits.
+        Returns False once the job is finished or gone."""
+        db = self.env.get_db_cnx()
+        cursor = QueryStats(self.env).cursor(db)
+        cursor.execute("SELECT new_name,next_id,max_id FROM multiproduct_product_rename "
+                       "WHERE old_name=%s", (old_name,))
+        row = cursor.fetchone()
+        if not row:
+            return False
+        new_name, next_id, max_id = row
+
+        if next_id > max_id:
+            self.log.info('Finished rename of product %s to %s', old_name, new_name)
+            cursor.execute("DELETE FROM multiproduct_product_rename WHERE old_name=%s",
+                           (old_name,))
+            # Tickets are counted under whichever name they had until now
+            TicketCountSummary(self.env).recount(db, [old_name, new_name])
+            ProductSystem(self.env).update_revision(db)
+            db.commit()
+            ProductSystem(self.env).reset_catalog()
+            return False
+
+        end_id = next_id + self.batch_size
+        cursor.execute("UPDATE ticket SET product=%s "
+                       "WHERE product=%s AND id>=%s AND id<%s",
+                       (new_name, old_name, next_id, end_id))
+        # Another process may be working on the same job, never go backwards
+        cursor.execute("UPDATE multiproduct_product_rename SET next_id=%s "
+                       "WHERE old_name=%s AND next_id<%s",
+                       (end_id, old_name, end_id))
+        db.commit()
+        return True
+
+    def _add_aliases(self, req, catalog):
+        """Makes ticket queries for a renamed product also match tickets that
+        still have the old name."""
+        values = req.args['product']
+        if not isinstance(values, list):
+            values = [values]
+        for value in list(values):
+            mode = ''
+            if value[:1] == '!':
+                mode, value = '!', value[1:]
+            for alias in catalog.aliases.get(value, []):
+                values.append(mode + alias)
+        req.args['product'] = values
@@ -0,0 +1,483 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import csv
+import inspect
+import sys
+from datetime import datetime
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from trac.core import *
+from trac.core import ComponentMeta
+from trac.env import open_environment
+from trac.ticket.model import simplify_whitespace
+from trac.util.datefmt import utc, to_timestamp
+
+from multiproduct import model
+from multiproduct.api import IAdminCommandProvider, ProductSystem
+from multiproduct.summary import TicketCountSummary
+
+__all__ = ['ProductAdminCommands']
+
+
+FIELDS = ['type', 'name', 'parent', 'owner', 'time', 'description']
+
+
+class ProductAdminCommands(Component):
+    """Provides admin commands for importing and exporting the product
+    catalog.
+
+    Catalogs are read and written as CSV or JSON Lines, one product, product
+    component or product version per record, with the fields `type` (one of
+    `product`, `component` or `version`), `name`, `parent` (the product of a
+    component or version, or the product a product is below), `owner`, `time`
+    (seconds since the epoch) and `description`.  Records are streamed, so
+    files of any size can be handled in constant memory."""
+
+    implements(IAdminCommandProvider)
+
+    batch_size = 1000
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('product export', '<csv|jsonl> [file]',
+               """Export the product catalog
+
+               Writes all products, product components and product versions to
+               the given file, or to standard output.""",
+               None, self._do_export)
+        yield ('product import', '<csv|jsonl> <file> [dry-run]',
+               """Import products, product components and product versions
+
+               Items that already exist are left alone.  Everything is
+               imported in a single transaction.  With "dry-run", only shows
+               what would be added or would differ from the current catalog.""",
+               None, self._do_import)
+        yield ('product migrate', '<default-product> [<csv|jsonl> <rules-file>] [dry-run]',
+               """Move tickets from the core component and version fields to the product fields
+
+               Sets the product, product component and product version of
+               every ticket that has no product yet, adding the components and
+               versions they use to the product catalog.  The product of a
+               ticket is found from its component, or failing that its
+               version, using the component and version records of the rules
+               file, whose parent names the product.  Tickets matching no rule
+               go to the default product.
+
+               Tickets are migrated in batches of ticket ids, committing after
+               each batch, and an interrupted migration carries on from the
+               last batch when run again.""",
+               None, self._do_migrate)
+        yield ('product check', '[clear | reassign <product>]',
+               """Find tickets whose product fields refer to things that don't exist
+
+               Reports the number of tickets by unknown product, and by product
+               component or product version that doesn't belong to the
+               ticket's product.  With "clear", unknown values are cleared.
+               With "reassign", tickets of unknown products are moved to the
+               given product instead, and their product component and version
+               are kept only where they exist in it.  Tickets are read and
+               repaired in batches of ticket ids, committing after each.""",
+               None, self._do_check)
+
+    # Internal methods
+
+    def _do_export(self, format, filename=None):
+        writer = self._get_writer(format)
+        if filename and filename != '-':
+            out = open(filename, 'wb')
+        else:
+            out = sys.stdout
+        try:
+            write = writer(out)
+            for product in model.Product.select_records(self.env):
+                write({'type': 'product', 'name': product.name, 'parent': product.parent,
+                       'owner': product.owner, 'description': product.description})
+            for prodcomp in model.ProductComponent.select_records(self.env):
+                write({'type': 'component', 'name': prodcomp.name,
+                       'parent': prodcomp.parent, 'description': prodcomp.description})
+            for prodver in model.ProductVersion.select_records(self.env):
+                write({'type': 'version', 'name': prodver.name,
+                       'parent': prodver.parent,
+                       'time': prodver.time and to_timestamp(prodver.time) or None,
+                       'description': prodver.description})
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    def _do_import(self, format, filename, dry_run=None):
+        if dry_run not in (None, 'dry-run'):
+            raise TracError('Unknown option "%s"' % dry_run)
+        reader = self._get_reader(format)
+        catalog = ProductSystem(self.env).get_catalog()
+        existing = {
+            'product': dict([((row[0],), tuple(row[:4])) for row in catalog.products]),
+            'component': dict([((row[0], row[1]), row) for row in catalog.components]),
+            'version': dict([((row[0], row[1]), row) for row in catalog.versions]),
+            }
+        added = dict([(kind, 0) for kind in existing])
+        skipped = 0
+
+        db = self.env.get_db_cnx()
+        batches = {'product': [], 'component': [], 'version': []}
+        def flush(kind):
+            rows = batches[kind]
+            if rows and not dry_run:
+                cls = {'product': model.Product,
+                       'component': model.ProductComponent,
+                       'version': model.ProductVersion}[kind]
+                cls.insert_many(self.env, rows, db=db)
+            added[kind] += len(rows)
+            batches[kind] = []
+
+        f = open(filename, 'rb')
+        try:
+            for lineno, record in enumerate(reader(f)):
+                kind = record.get('type')
+                if kind not in batches:
+                    raise TracError('Record %d: unknown type "%s"' % (lineno + 1, kind))
+                # Names are compared the way the model will store them
+                name = simplify_whitespace(record.get('name') or '')
+                parent = simplify_whitespace(record.get('parent') or '') or None
+                if not name or (kind != 'product' and not parent):
+                    raise TracError('Record %d: %s without a name or parent'
+                                    % (lineno + 1, kind))
+                description = record.get('description') or ''
+                if kind == 'product':
+                    key = (name,)
+                    row = (name, record.get('owner') or None, description, parent)
+                elif kind == 'component':
+                    key = (name, parent)
+                    row = (name, parent, description)
+                else:
+                    key = (name, parent)
+                    time = record.get('time')
+                    time = time and datetime.fromtimestamp(int(time), utc) or None
+                    row = (name, parent, time, description)
+
+                current = existing[kind].get(key)
+                if current is not None:
+                    if dry_run and current != row:
+                        self._print('~ %s %s: %r -> %r' % (kind, '/'.join(reversed(key)),
+                                                           current, row))
+                    skipped += 1
+                    continue
+                if dry_run:
+                    self._print('+ %s %s' % (kind, '/'.join(reversed(key))))
+
+                batches[kind].append(row)
+                # Later copies of the same record are skipped like existing ones
+                existing[kind][key] = row
+                if len(batches[kind]) >= self.batch_size:
+                    flush(kind)
+        finally:
+            f.close()
+
+        for kind in batches:
+            flush(kind)
+        if not dry_run:
+            system = ProductSystem(self.env)
+            system.update_revision(db)
+            db.commit()
+            system.reset_catalog()
+
+        self._print('%s %d products, %d components and %d versions, %d already existed'
+                    % (dry_run and 'Would import' or 'Imported', added['product'],
+                       added['component'], added['version'], skipped))
+
+    def _do_migrate(self, default_product, format=None, filename=None, dry_run=None):
+        if format == 'dry-run' and filename is None:
+            format, dry_run = None, format
+        if dry_run not in (None, 'dry-run') or (format and not filename):
+            raise TracError('Usage: product migrate <default-product> '
+                            '[<csv|jsonl> <rules-file>] [dry-run]')
+
+        rules = {'component': {}, 'version': {}}
+        if format:
+            reader = self._get_reader(format)
+            f = open(filename, 'rb')
+            try:
+                for lineno, record in enumerate(reader(f)):
+                    kind = record.get('type')
+                    if kind not in rules or not record.get('name') or not record.get('parent'):
+                        raise TracError('Record %d: expected a component or version '
+                                        'with a name and parent' % (lineno + 1))
+                    rules[kind][record['name']] = record['parent']
+            finally:
+                f.close()
+
+        system = ProductSystem(self.env)
+        catalog = system.get_catalog()
+        products = set([product.name for product in catalog.products])
+        for product in [default_product] + rules['component'].values() + \
+                       rules['version'].values():
+            if product not in products:
+                raise TracError('Product "%s" does not exist' % product)
+        components = set([(c.name, c.parent) for c in catalog.components])
+        versions = set([(v.name, v.parent) for v in catalog.versions])
+
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("SELECT name,description FROM component")
+        core_components = dict(cursor.fetchall())
+        cursor.execute("SELECT name,time,description FROM version")
+        core_versions = dict([(name, (time, description))
+                              for name, time, description in cursor.fetchall()])
+
+        # Only tickets without a product are touched, so the progress kept
+        # between runs just saves rescanning the tickets already done
+        cursor.execute("SELECT value FROM system WHERE name='multiproduct_migrate_next_id'")
+        row = cursor.fetchone()
+        next_id = row and int(row[0]) or 0
+        if next_id:
+            self._print('Resuming from ticket #%d' % next_id)
+        if not dry_run:
+            cursor.execute("DELETE FROM system WHERE name='multiproduct_migrate_next_id'")
+            cursor.execute("INSERT INTO system (name,value) "
+                           "VALUES ('multiproduct_migrate_next_id',%s)", (str(next_id),))
+            db.commit()
+
+        summary = TicketCountSummary(self.env)
+        migrated = added_components = added_versions = 0
+        while True:
+            cursor.execute("SELECT id,component,version,status,product_component,product_version "
+                           "FROM ticket WHERE id>=%%s AND (product IS NULL OR product='') "
+                           "ORDER BY id LIMIT %d" % self.batch_size, (next_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            updates = []
+            new_components = []
+            new_versions = []
+            deltas = {}
+            for id, component, version, status, old_component, old_version in rows:
+                component = simplify_whitespace(component or '')
+                version = simplify_whitespace(version or '')
+                product = rules['component'].get(component) or \
+                          rules['version'].get(version) or default_product
+                if component and (component, product) not in components:
+                    components.add((component, product))
+                    new_components.append((component, product,
+                                           core_components.get(component) or ''))
+                if version and (version, product) not in versions:
+                    versions.add((version, product))
+                    time, description = core_versions.get(version, (None, None))
+                    time = time and datetime.fromtimestamp(int(time), utc) or None
+                    new_versions.append((version, product, time, description or ''))
+                updates.append((product, component, version, id))
+                for key, delta in ((('', old_component or '', old_version or '',
+                                     status or ''), -1),
+                                   ((product, component, version, status or ''), 1)):
+                    deltas[key] = deltas.get(key, 0) + delta
+            next_id = rows[-1][0] + 1
+            migrated += len(rows)
+            added_components += len(new_components)
+            added_versions += len(new_versions)
+            if dry_run:
+                continue
+
+            def write():
+                if new_components:
+                    model.ProductComponent.insert_many(self.env, new_components, db=db)
+                if new_versions:
+                    model.ProductVersion.insert_many(self.env, new_versions, db=db)
+                cursor.executemany("UPDATE ticket SET product=%s,product_component=%s,"
+                                   "product_version=%s WHERE id=%s", updates)
+                summary.adjust(db, deltas)
+                cursor.execute("UPDATE system SET value=%s "
+                               "WHERE name='multiproduct_migrate_next_id'", (str(next_id),))
+                if new_components or new_versions:
+                    system.update_revision(db)
+            summary.commit_with_retry(db, write)
+            if new_components or new_versions:
+                system.reset_catalog()
+            self._print('Migrated tickets up to #%d' % rows[-1][0])
+
+        if not dry_run:
+            cursor.execute("DELETE FROM system WHERE name='multiproduct_migrate_next_id'")
+            db.commit()
+        self._print('%s %d tickets, adding %d components and %d versions'
+                    % (dry_run and 'Would migrate' or 'Migrated', migrated,
+                       added_components, added_versions))
+
+    def _do_check(self, repair=None, product=None):
+        if repair not in (None, 'clear', 'reassign') or \
+                (repair == 'reassign') != (product is not None):
+            raise TracError('Usage: product check [clear | reassign <product>]')
+
+        system = ProductSystem(self.env)
+        catalog = system.get_catalog()
+        # Old names of products still being renamed are as good as new ones
+        products = set([p.name for p in catalog.products] + catalog.renames.keys())
+        if product and product not in products:
+            raise TracError('Product "%s" does not exist' % product)
+        components = set([(c.parent, c.name) for c in catalog.components])
+        versions = set([(v.parent, v.name) for v in catalog.versions])
+        for old_name, new_name in catalog.renames.items():
+            components.update([(old_name, name) for parent, name in list(components)
+                               if parent == new_name])
+            versions.update([(old_name, name) for parent, name in list(versions)
+                             if parent == new_name])
+
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        summary = TicketCountSummary(self.env)
+        orphans = {'product': {}, 'component': {}, 'version': {}}
+        repaired = 0
+        last_id = 0
+        while True:
+            cursor.execute("SELECT id,product,product_component,product_version,status "
+                           "FROM ticket WHERE id>%%s ORDER BY id LIMIT %d"
+                           % self.batch_size, (last_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            updates = []
+            deltas = {}
+            for id, prod, comp, ver, status in rows:
+                new_prod, new_comp, new_ver = prod, comp, ver
+                if prod and prod not in products:
+                    orphans['product'][prod] = orphans['product'].get(prod, 0) + 1
+                    new_prod = product
+                else:
+                    if comp and (prod, comp) not in components:
+                        key = (prod, comp)
+                        orphans['component'][key] = orphans['component'].get(key, 0) + 1
+                        new_comp = None
+                    if ver and (prod, ver) not in versions:
+                        key = (prod, ver)
+                        orphans['version'][key] = orphans['version'].get(key, 0) + 1
+                        new_ver = None
+                if not repair or (new_prod, new_comp, new_ver) == (prod, comp, ver):
+                    continue
+                # A product's component and version are only kept if they
+                # exist in the product the ticket ends up in
+                if new_prod != prod:
+                    if not new_prod or (new_prod, comp) not in components:
+                        new_comp = None
+                    if not new_prod or (new_prod, ver) not in versions:
+                        new_ver = None
+                updates.append((new_prod, new_comp, new_ver, id))
+                for key, delta in (((prod or '', comp or '', ver or '', status or ''), -1),
+                                   ((new_prod or '', new_comp or '', new_ver or '',
+                                     status or ''), 1)):
+                    deltas[key] = deltas.get(key, 0) + delta
+
+            if updates:
+                def write():
+                    cursor.executemany("UPDATE ticket SET product=%s,product_component=%s,"
+                                       "product_version=%s WHERE id=%s", updates)
+                    summary.adjust(db, deltas)
+                summary.commit_with_retry(db, write)
+                repaired += len(updates)
+
+        for kind in ('product', 'component', 'version'):
+            counts = orphans[kind].items()
+            counts.sort()
+            for value, tickets in counts:
+                if kind == 'product':
+                    label = value
+                else:
+                    label = '/'.join([part or '' for part in value])
+                self._print('%s %s: %d tickets' % (kind, label, tickets))
+        self._print('%d tickets with unknown products, %d with unknown components, '
+                    '%d with unknown versions%s'
+                    % (sum(orphans['product'].values()),
+                       sum(orphans['component'].values()),
+                       sum(orphans['version'].values()),
+                       repair and ', %d repaired' % repaired or ''))
+
+    def _get_reader(self, format):
+        if format == 'csv':
+            def read(f):
+                for record in csv.DictReader(f):
+                    yield dict([(key, value and value.decode('utf-8'))
+                                for key, value in record.items()])
+        elif format == 'jsonl':
+            def read(f):
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        else:
+            raise TracError('Unknown format "%s", use csv or jsonl' % format)
+        return read
+
+    def _get_writer(self, format):
+        if format == 'csv':
+            def writer(out):
+                w = csv.DictWriter(out, FIELDS)
+                w.writerow(dict(zip(FIELDS, FIELDS)))
+                def write(record):
+                    w.writerow(dict([(key, isinstance(value, unicode) and
+                                           value.encode('utf-8') or value)
+                                     for key, value in record.items()]))
+                return write
+        elif format == 'jsonl':
+            def writer(out):
+                def write(record):
+                    out.write(json.dumps(record, separators=(',', ':')) + '\n')
+                return write
+        else:
+            raise TracError('Unknown format "%s", use csv or jsonl' % format)
+        return writer
+
+    def _print(self, line):
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        sys.stdout.write(line + '\n')
+
+
+def main(args=None):
+    """Runs the plug-in's admin commands on Trac versions whose trac-admin can't
+    be extended.
+
+        $ multiproduct-admin /path/to/env product export csv catalog.csv"""
+    if args is None:
+        args = sys.argv[1:]
+    if len(args) < 2:
+        sys.stderr.write('usage: multiproduct-admin </path/to/env> <command> [args...]\n')
+        return 2
+
+    env = open_environment(args[0])
+    words = args[1:]
+    commands = []
+    for cls in ComponentMeta._registry.get(IAdminCommandProvider, []):
+        if cls.__module__.startswith('multiproduct.') and env.is_component_enabled(cls):
+            commands.extend(cls(env).get_admin_commands())
+
+    for command, usage, help, complete, execute in commands:
+        length = len(command.split())
+        if words[:length] != command.split():
+            continue
+        args = words[length:]
+        argspec = inspect.getargspec(execute)
+        required = len(argspec[0]) - 1 - len(argspec[3] or ())
+        if not required <= len(args) <= len(argspec[0]) - 1:
+            sys.stderr.write('usage: multiproduct-admin </path/to/env> %s %s\n'
+                             % (command, usage))
+            return 2
+        try:
+            execute(*args)
+        except TracError, e:
+            sys.stderr.write('Error: %s\n' % e)
+            return 1
+        return 0
+
+    sys.stderr.write('Commands:\n')
+    for command, usage, help, complete, execute in commands:
+        sys.stderr.write('  %s %s\n      %s\n' % (command, usage, help.splitlines()[0]))
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,14 +5,22 @@
 
 jQuery(document).ready(function($) {
 	
-	/* get a list of all depselect fields and their parent fields */
-	/* TODO: don't hard code this list */
-	var depselects = new Array();
-	depselects.push(new Array("product_component","product"));
-	depselects.push(new Array("product_version","product"));
+	/* the list of all depselect fields and their parent fields is written into
+	   the page by the plug-in */
+	var depselects = multiproduct_depselects;
+	
+	/* fields with too many options to list become text inputs that suggest
+	   matching options, these have to be in place before any events are bound */
+	for(var i=0; i < multiproduct_autocomplete.length; i++) {
+		autocomplete(multiproduct_autocomplete[i]);
+	}
 	
 	for(var i=0; i < depselects.length; i++) {
 		
+		/* suggested fields have no secret select to fettle from */
+		if ($.inArray(depselects[i][0], multiproduct_autocomplete) != -1)
+			continue;
+		
 		/* parent field id */
 		var par_field = "#field-" + depselects[i][1];
 		
@@ -23,6 +31,12 @@ jQuery(document).ready(function($) {
 		children.push(depselects[i][0]);
 		$(par_field).data("children", children);
 		
+		/* the page only contains the options for the parent field's initial value,
+		   options for other values are fetched when they are first needed */
+		var loaded = new Object();
+		loaded[$(par_field).val()] = true;
+		$("#" + par_field.substring(1) + depselects[i][0]).data("loaded", loaded);
+		
 		/* add a change event to every parent field of a depselect field */
 		$(par_field).change(function() {
 			
@@ -34,22 +48,98 @@ jQuery(document).ready(function($) {
 			var children = $(this).data("children");
 			
 			for(var j=0; j < children.length; j++) {
-				
-				/* remove all the options from the depselect and replace with options from the
-				   secret select whose class matches the value selected in the parent field */
-				$("#field-" + children[j] + " option").remove();
-				$("#" + parent + children[j] + " option").filter(function(idx) {
-					return ($(this).text() == "" || $(this).attr("class") == $("#" + parent).val());
-				}).clone().appendTo($("#field-" + children[j]));
-				
-				/* set the default selected item to be the value in the ticket */
-				var selIdx = 0;
-				$("#field-" + children[j] + " option").filter(function(idx) {
-					if($(this).text() == $("#" + parent + children[j] + " option:selected").text())
-					selIdx = idx;
-					return true;
-				}).parent().attr("selectedIndex", selIdx);
+				load(parent, children[j]);
 			}
 		}).change();
 	}
+	
+	/* replace the select of a field with a text input, and a list of the
+	   options starting with what has been typed so far */
+	function autocomplete(name) {
+		var select = $("#field-" + name);
+		var input = $('<input type="text" autocomplete="off" />')
+			.attr("id", select.attr("id")).attr("name", select.attr("name"))
+			.val(select.val());
+		var list = $('<ul class="multiproduct-suggestions"></ul>').hide();
+		select.replaceWith(input);
+		input.after(list);
+		
+		var parent = null;
+		for(var j=0; j < depselects.length; j++) {
+			if (depselects[j][0] == name)
+				parent = depselects[j][1];
+		}
+		
+		input.keyup(function() {
+			var params = {q: input.val()};
+			if (parent != null)
+				params.parent = $("#field-" + parent).val();
+			$.getJSON(multiproduct_complete_url + "/" + name, params, function(names) {
+				/* a later key press has its own request on the way */
+				if (input.val() != params.q)
+					return;
+				list.empty();
+				for(var k=0; k < names.length; k++) {
+					$("<li></li>").text(names[k]).click(function() {
+						input.val($(this).text()).change();
+						list.hide();
+					}).appendTo(list);
+				}
+				if (names.length)
+					list.show();
+				else
+					list.hide();
+			});
+		}).blur(function() {
+			/* leave time for a click on a suggestion to land */
+			setTimeout(function() { list.hide(); }, 200);
+		});
+	}
+	
+	/* make sure the secret select holds the options for the value selected in the
+	   parent field before fettling the depselect */
+	function load(parent, child) {
+		var value = $("#" + parent).val();
+		var secret = $("#" + parent + child);
+		var loaded = secret.data("loaded");
+		if (loaded[value]) {
+			fettle(parent, child);
+			return;
+		}
+		/* already on its way, the pending request will do the fettling */
+		if (loaded[value] == false)
+			return;
+		loaded[value] = false;
+		$.getJSON(multiproduct_options_url + "/" + child, {parent: value}, function(names) {
+			loaded[value] = true;
+			for(var k=0; k < names.length; k++) {
+				$("<option></option>").text(names[k]).attr("class", value).appendTo(secret);
+			}
+			/* the parent field may have changed again while we were waiting */
+			if ($("#" + parent).val() == value)
+				fettle(parent, child);
+		});
+	}
+	
+	function fettle(parent, child) {
+		
+		/* remove all the options from the depselect and replace with options from the
+		   secret select whose class matches the value selected in the parent field */
+		$("#field-" + child + " option").remove();
+		$("#" + parent + child + " option").filter(function(idx) {
+			return ($(this).text() == "" || $(this).attr("class") == $("#" + parent).val());
+		}).clone().appendTo($("#field-" + child));
+		
+		/* set the default selected item to be the value in the ticket */
+		var selIdx = 0;
+		$("#field-" + child + " option").filter(function(idx) {
+			if($(this).text() == $("#" + parent + child + " option:selected").text())
+			selIdx = idx;
+			return true;
+		}).parent().attr("selectedIndex", selIdx);
+		
+		/* a depselect may itself be the parent of other depselects */
+		if ($("#field-" + child).data("children") != null)
+			$("#field-" + child).change();
+	}
 });
@@ -4,12 +4,19 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+import inspect
+import textwrap
+import threading
+
 from trac.core import *
+from trac.config import BoolOption
 from trac.db import DatabaseManager
 from trac.env import IEnvironmentSetupParticipant
+from trac.ticket.api import TicketSystem
 from trac.web.chrome import ITemplateProvider
 
-from multiproduct.model import schema, schema_ver
+from multiproduct.api import ProductSystem
+from multiproduct.model import schema, schema_ver, ticket_indexes
 
 __all__ = ['MultiProductPlugin']
 
@@ -19,6 +26,17 @@ class MultiProductPlugin(Component):
 
     implements(IEnvironmentSetupParticipant, ITemplateProvider)
 
+    prewarm = BoolOption('multiproduct', 'prewarm_catalog', 'false',
+        """Whether to load the product catalog and build the ticket fields in
+        the background as soon as the environment is opened, rather than on
+        the first request that needs them.""")
+
+    def __init__(self):
+        if self.prewarm:
+            thread = threading.Thread(target=self._prewarm, name='multiproduct-prewarm')
+            thread.setDaemon(True)
+            thread.start()
+
     # ITemplateProvider methods
 
     def get_htdocs_dirs(self):
@@ -45,10 +63,13 @@ class MultiProductPlugin(Component):
         cursor.execute("ALTER TABLE ticket ADD COLUMN product TEXT")
         cursor.execute("ALTER TABLE ticket ADD COLUMN product_component TEXT")
         cursor.execute("ALTER TABLE ticket ADD COLUMN product_version TEXT")
+        for stmt in ticket_indexes:
+            cursor.execute(stmt)
 
         # Insert a schema version flag
         cursor.execute("INSERT INTO system (name,value) VALUES ('multiproduct_version',%s)",
                        (schema_ver,))
+        cursor.execute("INSERT INTO system (name,value) VALUES ('multiproduct_catalog_rev','0')")
 
         db.commit()
 
@@ -69,7 +90,7 @@ class MultiProductPlugin(Component):
             current_version = int(row[0])
             from multiproduct import upgrades
             for version in range(current_version + 1, schema_ver + 1):
-                for function in upgrades.map.get(version):
+                for function in upgrades.map.get(version, []):
                     print textwrap.fill(inspect.getdoc(function))
                     function(self.env, db)
                     print 'Done.'
@@ -77,5 +98,21 @@ class MultiProductPlugin(Component):
             # Update the schema version flag
             cursor.execute("UPDATE system SET value=%s WHERE name='multiproduct_version'",
                            (schema_ver,))
+
+            # Upgrades may change what the catalog holds, which makes cached
+            # copies and snapshots of it stale
+            ProductSystem(self.env).update_revision(db)
+
             self.log.info('Upgraded MultiProduct tables from version %d to %d',
                           current_version, schema_ver)
+
+    # Internal methods
+
+    def _prewarm(self):
+        try:
+            ProductSystem(self.env).get_catalog()
+            TicketSystem(self.env).get_ticket_fields()
+        except Exception, e:
+            # Typically the environment still needs upgrading, in which case
+            # the first request loads everything once it has been
+            self.log.warning('Could not pre-warm the product catalog: %s', e)
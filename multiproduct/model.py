@@ -4,17 +4,20 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+import re
 from datetime import datetime
 
 from trac.core import *
-from trac.db import Table, Column
+from trac.db import Table, Column, Index
 from trac.resource import ResourceNotFound
-from trac.ticket.api import TicketSystem
 from trac.ticket.model import simplify_whitespace
-from trac.util import embedded_numbers, sorted
-from trac.util.datefmt import utc, utcmax, to_timestamp
+from trac.util.datefmt import utc, to_timestamp
 from trac.util.translation import _
 
+from multiproduct import cascade, summary
+from multiproduct.api import ProductSystem
+from multiproduct.stats import QueryStats
+
 
 class Product(object):
 
@@ -23,6 +26,9 @@ class Product(object):
             Column('name'),
             Column('owner'),
             Column('description'),
+            Column('parent'),
+            Column('path'),
+            Index(['path']),
             ]
         ]
 
@@ -31,10 +37,9 @@ class Product(object):
         if name:
             name = simplify_whitespace(name)
         if name:
-            if not db:
-                db = self.env.get_db_cnx()
-            cursor = db.cursor()
-            cursor.execute("SELECT owner,description FROM multiproduct_product "
+            db = ProductSystem(self.env).get_db(db)
+            cursor = QueryStats(self.env).cursor(db)
+            cursor.execute("SELECT owner,description,parent,path FROM multiproduct_product "
                            "WHERE name=%s", (name,))
             row = cursor.fetchone()
             if not row:
@@ -43,98 +48,263 @@ class Product(object):
             self.name = self._old_name = name
             self.owner = row[0] or None
             self.description = row[1] or ''
+            self.parent = self._old_parent = row[2] or None
+            self._path = row[3]
         else:
             self.name = self._old_name = None
             self.owner = None
             self.description = None
+            self.parent = self._old_parent = None
+            self._path = None
 
     exists = property(fget=lambda self: self._old_name is not None)
 
     def delete(self, db=None):
         assert self.exists, 'Cannot delete non-existent product'
-        if not db:
-            db = self.env.get_db_cnx()
-            handle_ta = True
-        else:
-            handle_ta = False
+        db, handle_ta = ProductSystem(self.env).begin_write(db)
 
-        cursor = db.cursor()
+        cursor = QueryStats(self.env).cursor(db)
         self.env.log.info('Deleting product %s' % self.name)
+        _detach_product(self.env, db, self.name)
+        components, versions = _get_product_options(self.env, db, [self.name])
         cursor.execute("DELETE FROM multiproduct_product WHERE name=%s", (self.name,))
         cursor.execute("DELETE FROM multiproduct_product_component WHERE parent=%s", (self.name,))
         cursor.execute("DELETE FROM multiproduct_product_version WHERE parent=%s", (self.name,))
+        _delete_depselect_options(self.env, cursor, 'product', [self.name])
+        _delete_depselect_options(self.env, cursor, 'product_component', components)
+        _delete_depselect_options(self.env, cursor, 'product_version', versions)
 
         self.name = self._old_name = None
+        self.parent = self._old_parent = None
+        self._path = None
 
-        if handle_ta:
-            db.commit()
-        TicketSystem(self.env).reset_ticket_fields()
+        ProductSystem(self.env).end_write(db, handle_ta)
 
     def insert(self, db=None):
         assert not self.exists, 'Cannot insert existing product'
         self.name = simplify_whitespace(self.name)
         assert self.name, 'Cannot create product with no name'
-        if not db:
-            db = self.env.get_db_cnx()
-            handle_ta = True
-        else:
-            handle_ta = False
+        self.parent = self.parent and simplify_whitespace(self.parent) or None
+        db, handle_ta = ProductSystem(self.env).begin_write(db)
 
-        cursor = db.cursor()
+        cursor = QueryStats(self.env).cursor(db)
         self.env.log.debug("Creating new product '%s'" % self.name)
-        cursor.execute("INSERT INTO multiproduct_product (name,owner,description) "
-                       "VALUES (%s,%s,%s)",
-                       (self.name, self.owner, self.description))
+        _check_pending_rename(self.env, db, self.name)
+        self._path = product_path(self.name, _get_path(self.env, db, self.parent))
+        cursor.execute("INSERT INTO multiproduct_product (name,owner,description,parent,path) "
+                       "VALUES (%s,%s,%s,%s,%s)",
+                       (self.name, self.owner, self.description, self.parent, self._path))
+        self._old_parent = self.parent
 
-        if handle_ta:
-            db.commit()
-        TicketSystem(self.env).reset_ticket_fields()
+        ProductSystem(self.env).end_write(db, handle_ta)
 
     def update(self, db=None):
         assert self.exists, 'Cannot update non-existent product'
         self.name = simplify_whitespace(self.name)
         assert self.name, 'Cannot update product with no name'
-        if not db:
-            db = self.env.get_db_cnx()
-            handle_ta = True
-        else:
-            handle_ta = False
+        self.parent = self.parent and simplify_whitespace(self.parent) or None
+        db, handle_ta = ProductSystem(self.env).begin_write(db)
 
-        cursor = db.cursor()
+        cursor = QueryStats(self.env).cursor(db)
         self.env.log.info('Updating product "%s"' % self.name)
-        cursor.execute("UPDATE multiproduct_product SET name=%s,owner=%s,description=%s "
-                       "WHERE name=%s",
-                       (self.name, self.owner, self.description,
+        path = self._path
+        if self.name != self._old_name:
+            _check_pending_rename(self.env, db, self.name)
+        if self.name != self._old_name or self.parent != self._old_parent:
+            parent_path = _get_path(self.env, db, self.parent)
+            if parent_path.startswith(self._path):
+                raise TracError(_('Product %(name)s can not be moved below itself.',
+                                  name=self.name))
+            path = product_path(self.name, parent_path)
+        cursor.execute("UPDATE multiproduct_product SET name=%s,owner=%s,description=%s,"
+                       "parent=%s,path=%s WHERE name=%s",
+                       (self.name, self.owner, self.description, self.parent, path,
                         self._old_name))
+        if path != self._path:
+            # Move the whole subtree along in one statement
+            _move_subtree(db, cursor, self._path, path)
+            self._path = path
+        self._old_parent = self.parent
         if self.name != self._old_name:
             # Update tickets
-            cursor.execute("UPDATE ticket SET product=%s WHERE product=%s",
-                           (self.name, self._old_name))
+            renamer = cascade.RenameCascade(self.env)
+            if renamer.deferred:
+                renamer.queue_rename(self._old_name, self.name, db)
+            else:
+                cursor.execute("UPDATE ticket SET product=%s WHERE product=%s",
+                               (self.name, self._old_name))
+                summary.TicketCountSummary(self.env).recount(db, [self._old_name,
+                                                                  self.name])
             # Update dependent fields
+            cursor.execute("UPDATE multiproduct_product SET parent=%s WHERE parent=%s",
+                           (self.name, self._old_name))
             cursor.execute("UPDATE multiproduct_product_component SET parent=%s WHERE parent=%s", 
                            (self.name, self._old_name)) 
             cursor.execute("UPDATE multiproduct_product_version SET parent=%s WHERE parent=%s", 
                            (self.name, self._old_name))
+            _update_depselect_parents(self.env, cursor, 'product', self._old_name, self.name)
             self._old_name = self.name
 
-        if handle_ta:
-            db.commit()
-        TicketSystem(self.env).reset_ticket_fields()
+        ProductSystem(self.env).end_write(db, handle_ta)
 
     def select(cls, env, db=None):
-        if not db:
-            db = env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("SELECT name,owner,description FROM multiproduct_product "
-                       "ORDER BY name")
-        for name, owner, description in cursor:
+        catalog = ProductSystem(env).get_catalog(db)
+        for name, owner, description, parent, path in catalog.products:
             product = cls(env)
             product.name = product._old_name = name
-            product.owner = owner or None
-            product.description = description or ''
+            product.owner = owner
+            product.description = description
+            product.parent = product._old_parent = parent
+            product._path = path
             yield product
     select = classmethod(select)
 
+    def select_records(cls, env, db=None):
+        """Returns read-only records of all products.  These are shared with the
+        catalog cache, so they are much cheaper than model objects where nothing
+        is going to be changed."""
+        return iter(ProductSystem(env).get_catalog(db).products)
+    select_records = classmethod(select_records)
+
+    def select_subtree(cls, env, name, db=None):
+        """Returns the names of a product and of all products below it, with a
+        single indexed query on the product paths."""
+        db = ProductSystem(env).get_db(db)
+        cursor = QueryStats(env).cursor(db)
+        path = _get_path(env, db, simplify_whitespace(name))
+        cursor.execute("SELECT name FROM multiproduct_product WHERE path " + db.like(),
+                       (db.like_escape(path) + '%',))
+        return [name for name, in cursor]
+    select_subtree = classmethod(select_subtree)
+
+    def insert_many(cls, env, rows, db=None):
+        """Creates several products using a single transaction.  Rows are
+        (name, owner, description, parent) tuples, where the parent must either
+        exist already or come earlier in the rows.
+
+        If `db` is given, the caller is responsible for updating the catalog
+        revision, committing and resetting the catalog, once for all of its
+        changes."""
+        db, handle_ta = ProductSystem(env).begin_write(db)
+
+        paths = {}
+        args = []
+        for name, owner, description, parent in rows:
+            name = simplify_whitespace(name)
+            assert name, 'Cannot create product with no name'
+            parent = parent and simplify_whitespace(parent) or None
+            _check_pending_rename(env, db, name)
+            if parent not in paths:
+                paths[parent] = _get_path(env, db, parent)
+            paths[name] = product_path(name, paths[parent])
+            args.append((name, owner, description, parent, paths[name]))
+
+        cursor = QueryStats(env).cursor(db)
+        env.log.debug("Creating %d new products" % len(args))
+        cursor.executemany("INSERT INTO multiproduct_product "
+                           "(name,owner,description,parent,path) "
+                           "VALUES (%s,%s,%s,%s,%s)", args)
+
+        ProductSystem(env).end_write(db, handle_ta, bulk=True)
+    insert_many = classmethod(insert_many)
+
+    def delete_many(cls, env, names, db=None):
+        """Deletes several products, and their product components and versions,
+        using a single transaction.  Names that don't exist are ignored.
+        Products below the deleted ones move up to the nearest remaining
+        ancestor.
+
+        If `db` is given, the caller is responsible for updating the catalog
+        revision, committing and resetting the catalog, once for all of its
+        changes."""
+        names = [simplify_whitespace(name) for name in names]
+        db, handle_ta = ProductSystem(env).begin_write(db)
+
+        cursor = QueryStats(env).cursor(db)
+        env.log.info('Deleting products %s' % ', '.join(names))
+        for name in names:
+            _detach_product(env, db, name)
+        components, versions = _get_product_options(env, db, names)
+        args = [(name,) for name in names]
+        cursor.executemany("DELETE FROM multiproduct_product WHERE name=%s", args)
+        cursor.executemany("DELETE FROM multiproduct_product_component WHERE parent=%s", args)
+        cursor.executemany("DELETE FROM multiproduct_product_version WHERE parent=%s", args)
+        _delete_depselect_options(env, cursor, 'product', names)
+        _delete_depselect_options(env, cursor, 'product_component', components)
+        _delete_depselect_options(env, cursor, 'product_version', versions)
+        ProductSystem(env).end_write(db, handle_ta, bulk=True)
+    delete_many = classmethod(delete_many)
+
+
+def product_path(name, parent_path=''):
+    """Returns the materialized path of a product, i.e. the names of its
+    ancestors and its own, each followed by a slash.  Slashes and backslashes
+    in names are escaped, so the path of a product is a prefix of the paths of
+    exactly the products below it."""
+    return parent_path + name.replace('\\', '\\\\').replace('/', '\\/') + '/'
+
+def _get_path(env, db, name):
+    if not name:
+        return ''
+    cursor = QueryStats(env).cursor(db)
+    cursor.execute("SELECT path FROM multiproduct_product WHERE name=%s", (name,))
+    row = cursor.fetchone()
+    if not row:
+        raise ResourceNotFound(_('Product %(name)s does not exist.', name=name))
+    return row[0]
+
+def _move_subtree(db, cursor, old_path, new_path):
+    """Rewrites the paths of the products below `old_path` to be below
+    `new_path` instead."""
+    cursor.execute("UPDATE multiproduct_product SET path=%s WHERE path %s"
+                   % (db.concat('%s', 'SUBSTR(path,%d)' % (len(old_path) + 1)), db.like()),
+                   (new_path, db.like_escape(old_path) + '_%'))
+
+def _check_pending_rename(env, db, name):
+    """Refuses a product name that is still the old name of a product being
+    renamed in the background, as the rename would take its tickets too."""
+    cursor = QueryStats(env).cursor(db)
+    cursor.execute("SELECT new_name FROM multiproduct_product_rename WHERE old_name=%s",
+                   (name,))
+    row = cursor.fetchone()
+    if row:
+        raise TracError(_('Product %(name)s is still being renamed to %(new_name)s, '
+                          'its name can not be used until that has finished.',
+                          name=name, new_name=row[0]))
+
+def _get_old_names(env, db, name):
+    """Returns the name of a product along with the old names that tickets
+    may still have while renames of the product are pending."""
+    return [name] + ProductSystem(env).get_catalog(db).aliases.get(name, [])
+
+def _get_product_options(env, db, names):
+    """Returns the names of the product components and of the product versions
+    of the given products."""
+    cursor = QueryStats(env).cursor(db)
+    components = set()
+    versions = set()
+    for name in names:
+        cursor.execute("SELECT name FROM multiproduct_product_component WHERE parent=%s",
+                       (name,))
+        components.update([component for component, in cursor])
+        cursor.execute("SELECT name FROM multiproduct_product_version WHERE parent=%s",
+                       (name,))
+        versions.update([version for version, in cursor])
+    return components, versions
+
+def _detach_product(env, db, name):
+    """Moves the products directly below a product that is about to be
+    deleted up to its parent."""
+    cursor = QueryStats(env).cursor(db)
+    cursor.execute("SELECT parent,path FROM multiproduct_product WHERE name=%s", (name,))
+    row = cursor.fetchone()
+    if not row:
+        return
+    parent, path = row
+    cursor.execute("UPDATE multiproduct_product SET parent=%s WHERE parent=%s",
+                   (parent, name))
+    _move_subtree(db, cursor, path, path[:-len(product_path(name))])
+
 
 class ProductComponent(object):
 
@@ -153,9 +323,8 @@ class ProductComponent(object):
         if parent:
             parent = simplify_whitespace(parent)
         if name and parent:
-            if not db:
-                db = self.env.get_db_cnx()
-            cursor = db.cursor()
+            db = ProductSystem(self.env).get_db(db)
+            cursor = QueryStats(self.env).cursor(db)
             cursor.execute("SELECT description FROM multiproduct_product_component "
                            "WHERE name=%s AND parent=%s", (name, parent))
             row = cursor.fetchone()
@@ -175,23 +344,18 @@ class ProductComponent(object):
 
     def delete(self, db=None):
         assert self.exists, 'Cannot delete non-existent product component'
-        if not db:
-            db = self.env.get_db_cnx()
-            handle_ta = True
-        else:
-            handle_ta = False
+        db, handle_ta = ProductSystem(self.env).begin_write(db)
 
-        cursor = db.cursor()
+        cursor = QueryStats(self.env).cursor(db)
         self.env.log.info('Deleting product component %s' % self.name)
         cursor.execute("DELETE FROM multiproduct_product_component WHERE name=%s AND parent=%s",
                        (self.name, self.parent))
+        _delete_depselect_options(self.env, cursor, 'product_component', [self.name])
 
         self.name = self._old_name = None
         self.parent = self._old_parent = None
 
-        if handle_ta:
-            db.commit()
-        TicketSystem(self.env).reset_ticket_fields()
+        ProductSystem(self.env).end_write(db, handle_ta)
 
     def insert(self, db=None):
         assert not self.exists, 'Cannot insert existing product component'
@@ -199,20 +363,14 @@ class ProductComponent(object):
         self.parent = simplify_whitespace(self.parent)
         assert self.name, 'Cannot create product component with no name'
         assert self.parent, 'Cannot create product component with no parent'
-        if not db:
-            db = self.env.get_db_cnx()
-            handle_ta = True
-        else:
-            handle_ta = False
+        db, handle_ta = ProductSystem(self.env).begin_write(db)
 
-        cursor = db.cursor()
+        cursor = QueryStats(self.env).cursor(db)
         self.env.log.debug("Creating new product component '%s'" % self.name)
         cursor.execute("INSERT INTO multiproduct_product_component (name,description,parent) "
                        "VALUES (%s,%s,%s)", (self.name, self.description, self.parent))
 
-        if handle_ta:
-            db.commit()
-        TicketSystem(self.env).reset_ticket_fields()
+        ProductSystem(self.env).end_write(db, handle_ta)
 
     def update(self, db=None):
         assert self.exists, 'Cannot update non-existent product component'
@@ -220,47 +378,130 @@ class ProductComponent(object):
         self.parent = simplify_whitespace(self.parent)
         assert self.name, 'Cannot update product component with no name'
         assert self.parent, 'Cannot update product component with no parent'
-        if not db:
-            db = self.env.get_db_cnx()
-            handle_ta = True
-        else:
-            handle_ta = False
+        db, handle_ta = ProductSystem(self.env).begin_write(db)
 
-        cursor = db.cursor()
+        cursor = QueryStats(self.env).cursor(db)
         self.env.log.info('Updating product component "%s"' % self.name)
         cursor.execute("UPDATE multiproduct_product_component SET name=%s,description=%s,parent=%s "
                        "WHERE name=%s AND parent=%s",
                        (self.name, self.description, self.parent,
                         self._old_name, self._old_parent))
         if self.name != self._old_name or self.parent != self._old_parent:
-            # Update tickets
+            # Update tickets, including those still waiting for a rename of
+            # their product
+            old_parents = _get_old_names(self.env, db, self._old_parent)
             cursor.execute("UPDATE ticket SET product=%s, product_component=%s "
-                           "WHERE product=%s AND product_component=%s",
-                           (self.parent, self.name, self._old_parent, self._old_name))
+                           "WHERE product IN (" + ','.join(['%s'] * len(old_parents)) +
+                           ") AND product_component=%s",
+                           [self.parent, self.name] + old_parents + [self._old_name])
+            if self.name != self._old_name:
+                _update_depselect_parents(self.env, cursor, 'product_component',
+                                          self._old_name, self.name)
+            summary.TicketCountSummary(self.env).recount(db, old_parents +
+                                                         [self.parent])
             self._old_name = self.name
             self._old_parent = self.parent
 
-        if handle_ta:
-            db.commit()
-        TicketSystem(self.env).reset_ticket_fields()
+        ProductSystem(self.env).end_write(db, handle_ta)
 
     def select(cls, env, db=None, parent=None):
-        if not db:
-            db = env.get_db_cnx()
-        cursor = db.cursor()
+        catalog = ProductSystem(env).get_catalog(db)
         if parent:
-            cursor.execute("SELECT name,parent,description FROM multiproduct_product_component "
-                           "WHERE parent=%s ORDER BY name", (parent,))
+            rows = catalog.components_by_parent.get(parent, [])
         else:
-            cursor.execute("SELECT name,parent,description FROM multiproduct_product_component "
-                           "ORDER BY parent,name")
+            rows = catalog.components
+        for name, parent, description in rows:
+            prodcomp = cls(env)
+            prodcomp.name = prodcomp._old_name = name
+            prodcomp.parent = prodcomp._old_parent = parent
+            prodcomp.description = description
+            yield prodcomp
+    select = classmethod(select)
+
+    def select_records(cls, env, db=None, parent=None):
+        """Returns read-only records of the product components, of all products or of
+        the given one.  These are shared with the catalog cache, so they are much
+        cheaper than model objects where nothing is going to be changed."""
+        catalog = ProductSystem(env).get_catalog(db)
+        if parent:
+            return iter(catalog.components_by_parent.get(parent, []))
+        return iter(catalog.components)
+    select_records = classmethod(select_records)
+
+    def select_options(cls, env, db=None):
+        """Returns the names and parents of all product components as (name, parent)
+        tuples, e.g. for building the options of the depselect field."""
+        return ProductSystem(env).get_catalog(db).get_options_list('product_component')
+    select_options = classmethod(select_options)
+
+    def select_page(cls, env, parent, after=None, limit=100, name_filter=None, db=None):
+        """Reads a page of the components of a product from the database, in
+        name order.  Pages are addressed by the name of the last component of
+        the previous page, `after`, so reading any page costs the same.  If
+        `name_filter` is given, only components whose names contain it are
+        returned."""
+        db = ProductSystem(env).get_db(db)
+        cursor = QueryStats(env).cursor(db)
+        sql = "SELECT name,parent,description FROM multiproduct_product_component " \
+              "WHERE parent=%s"
+        args = [parent]
+        if after:
+            sql += " AND name>%s"
+            args.append(after)
+        if name_filter:
+            sql += " AND name " + db.like()
+            args.append('%' + db.like_escape(name_filter) + '%')
+        sql += " ORDER BY name LIMIT %d" % limit
+        cursor.execute(sql, args)
         for name, parent, description in cursor:
             prodcomp = cls(env)
             prodcomp.name = prodcomp._old_name = name
             prodcomp.parent = prodcomp._old_parent = parent
             prodcomp.description = description or ''
             yield prodcomp
-    select = classmethod(select)
+    select_page = classmethod(select_page)
+
+    def insert_many(cls, env, rows, db=None):
+        """Creates several product components using a single transaction.  Rows
+        are (name, parent, description) tuples.
+
+        If `db` is given, the caller is responsible for updating the catalog
+        revision, committing and resetting the catalog, once for all of its
+        changes."""
+        args = []
+        for name, parent, description in rows:
+            name = simplify_whitespace(name)
+            parent = simplify_whitespace(parent)
+            assert name, 'Cannot create product component with no name'
+            assert parent, 'Cannot create product component with no parent'
+            args.append((name, description, parent))
+        db, handle_ta = ProductSystem(env).begin_write(db)
+
+        cursor = QueryStats(env).cursor(db)
+        env.log.debug("Creating %d new product components" % len(args))
+        cursor.executemany("INSERT INTO multiproduct_product_component (name,description,parent) "
+                           "VALUES (%s,%s,%s)", args)
+        ProductSystem(env).end_write(db, handle_ta, bulk=True)
+    insert_many = classmethod(insert_many)
+
+    def delete_many(cls, env, names, parent, db=None):
+        """Deletes several product components of the same product using a single
+        transaction.  Names that don't exist are ignored.
+
+        If `db` is given, the caller is responsible for updating the catalog
+        revision, committing and resetting the catalog, once for all of its
+        changes."""
+        names = [simplify_whitespace(name) for name in names]
+        parent = simplify_whitespace(parent)
+        db, handle_ta = ProductSystem(env).begin_write(db)
+
+        cursor = QueryStats(env).cursor(db)
+        env.log.info('Deleting product components %s' % ', '.join(names))
+        cursor.executemany("DELETE FROM multiproduct_product_component WHERE name=%s AND parent=%s",
+                           [(name, parent) for name in names])
+        _delete_depselect_options(env, cursor, 'product_component', names)
+        ProductSystem(env).end_write(db, handle_ta, bulk=True)
+    delete_many = classmethod(delete_many)
 
 
 class ProductVersion(object):
@@ -271,6 +512,8 @@ class ProductVersion(object):
             Column('name'),
             Column('time', type='int'),
             Column('description'),
+            Column('sort_key'),
+            Index(['parent', 'sort_key']),
             ]
         ]
 
@@ -281,9 +524,8 @@ class ProductVersion(object):
         if parent:
             parent = simplify_whitespace(parent)
         if name and parent:
-            if not db:
-                db = self.env.get_db_cnx()
-            cursor = db.cursor()
+            db = ProductSystem(self.env).get_db(db)
+            cursor = QueryStats(self.env).cursor(db)
             cursor.execute("SELECT time,description FROM multiproduct_product_version "
                            "WHERE name=%s AND parent=%s", (name, parent))
             row = cursor.fetchone()
@@ -305,23 +547,18 @@ class ProductVersion(object):
 
     def delete(self, db=None):
         assert self.exists, 'Cannot delete non-existent product version'
-        if not db:
-            db = self.env.get_db_cnx()
-            handle_ta = True
-        else:
-            handle_ta = False
+        db, handle_ta = ProductSystem(self.env).begin_write(db)
 
-        cursor = db.cursor()
+        cursor = QueryStats(self.env).cursor(db)
         self.env.log.info('Deleting product version %s' % self.name)
         cursor.execute("DELETE FROM multiproduct_product_version WHERE name=%s AND parent=%s",
                        (self.name, self.parent))
+        _delete_depselect_options(self.env, cursor, 'product_version', [self.name])
 
         self.name = self._old_name = None
         self.parent = self._old_parent = None
 
-        if handle_ta:
-            db.commit()
-        TicketSystem(self.env).reset_ticket_fields()
+        ProductSystem(self.env).end_write(db, handle_ta)
 
     def insert(self, db=None):
         assert not self.exists, 'Cannot insert existing product version'
@@ -329,20 +566,15 @@ class ProductVersion(object):
         self.parent = simplify_whitespace(self.parent)
         assert self.name, 'Cannot create product version with no name'
         assert self.parent, 'Cannot create product version with no parent'
-        if not db:
-            db = self.env.get_db_cnx()
-            handle_ta = True
-        else:
-            handle_ta = False
+        db, handle_ta = ProductSystem(self.env).begin_write(db)
 
-        cursor = db.cursor()
+        cursor = QueryStats(self.env).cursor(db)
         self.env.log.debug("Creating new product version '%s'" % self.name)
-        cursor.execute("INSERT INTO multiproduct_product_version (name,time,description,parent) "
-                       "VALUES (%s,%s,%s,%s)", (self.name, to_timestamp(self.time), self.description, self.parent))
+        cursor.execute("INSERT INTO multiproduct_product_version (name,time,description,parent,sort_key) "
+                       "VALUES (%s,%s,%s,%s,%s)", (self.name, to_timestamp(self.time), self.description, self.parent,
+                                                   version_sort_key(self.name, self.time)))
 
-        if handle_ta:
-            db.commit()
-        TicketSystem(self.env).reset_ticket_fields()
+        ProductSystem(self.env).end_write(db, handle_ta)
 
     def update(self, db=None):
         assert self.exists, 'Cannot update non-existent product version'
@@ -350,52 +582,319 @@ class ProductVersion(object):
         self.parent = simplify_whitespace(self.parent)
         assert self.name, 'Cannot update product version with no name'
         assert self.parent, 'Cannot update product version with no parent'
-        if not db:
-            db = self.env.get_db_cnx()
-            handle_ta = True
-        else:
-            handle_ta = False
+        db, handle_ta = ProductSystem(self.env).begin_write(db)
 
-        cursor = db.cursor()
+        cursor = QueryStats(self.env).cursor(db)
         self.env.log.info('Updating product version "%s"' % self.name)
-        cursor.execute("UPDATE multiproduct_product_version SET name=%s,time=%s,description=%s,parent=%s "
+        cursor.execute("UPDATE multiproduct_product_version SET name=%s,time=%s,description=%s,parent=%s,sort_key=%s "
                        "WHERE name=%s AND parent=%s",
                        (self.name, to_timestamp(self.time), self.description, self.parent,
+                        version_sort_key(self.name, self.time),
                         self._old_name, self._old_parent))
         if self.name != self._old_name or self.parent != self._old_parent:
-            # Update tickets
+            # Update tickets, including those still waiting for a rename of
+            # their product
+            old_parents = _get_old_names(self.env, db, self._old_parent)
             cursor.execute("UPDATE ticket SET product=%s, product_version=%s "
-                           "WHERE product=%s AND product_version=%s",
-                           (self.parent, self.name, self._old_parent, self._old_name))
+                           "WHERE product IN (" + ','.join(['%s'] * len(old_parents)) +
+                           ") AND product_version=%s",
+                           [self.parent, self.name] + old_parents + [self._old_name])
+            if self.name != self._old_name:
+                _update_depselect_parents(self.env, cursor, 'product_version',
+                                          self._old_name, self.name)
+            summary.TicketCountSummary(self.env).recount(db, old_parents +
+                                                         [self.parent])
             self._old_name = self.name
             self._old_parent = self.parent
 
-        if handle_ta:
-            db.commit()
-        TicketSystem(self.env).reset_ticket_fields()
+        ProductSystem(self.env).end_write(db, handle_ta)
 
     def select(cls, env, db=None, parent=None):
-        if not db:
-            db = env.get_db_cnx()
-        cursor = db.cursor()
+        catalog = ProductSystem(env).get_catalog(db)
         if parent:
-            cursor.execute("SELECT name,parent,time,description FROM multiproduct_product_version "
-                           "WHERE parent=%s", (parent,))
+            rows = catalog.versions_by_parent.get(parent, [])
         else:
-            cursor.execute("SELECT name,parent,time,description FROM multiproduct_product_version")
-        versions = []
+            rows = catalog.versions
+        # The catalog already holds versions in display order
+        for name, parent, time, description in rows:
+            prodversion = cls(env)
+            prodversion.name = prodversion._old_name = name
+            prodversion.parent = prodversion._old_parent = parent
+            prodversion.time = time
+            prodversion.description = description
+            yield prodversion
+    select = classmethod(select)
+
+    def select_records(cls, env, db=None, parent=None):
+        """Returns read-only records of the product versions, of all products or of
+        the given one.  These are shared with the catalog cache, so they are much
+        cheaper than model objects where nothing is going to be changed."""
+        catalog = ProductSystem(env).get_catalog(db)
+        if parent:
+            return iter(catalog.versions_by_parent.get(parent, []))
+        return iter(catalog.versions)
+    select_records = classmethod(select_records)
+
+    def select_options(cls, env, db=None):
+        """Returns the names and parents of all product versions as (name, parent)
+        tuples, e.g. for building the options of the depselect field."""
+        return ProductSystem(env).get_catalog(db).get_options_list('product_version')
+    select_options = classmethod(select_options)
+
+    def select_page(cls, env, parent, after=None, limit=100, name_filter=None, db=None):
+        """Reads a page of the versions of a product from the database, in
+        display order.  Pages are addressed by the sort key of the last version
+        of the previous page, `after`, so reading any page costs the same.  If
+        `name_filter` is given, only versions whose names contain it are
+        returned."""
+        db = ProductSystem(env).get_db(db)
+        cursor = QueryStats(env).cursor(db)
+        sql = "SELECT name,parent,time,description FROM multiproduct_product_version " \
+              "WHERE parent=%s"
+        args = [parent]
+        if after:
+            sql += " AND sort_key<%s"
+            args.append(after)
+        if name_filter:
+            sql += " AND name " + db.like()
+            args.append('%' + db.like_escape(name_filter) + '%')
+        sql += " ORDER BY sort_key DESC LIMIT %d" % limit
+        cursor.execute(sql, args)
         for name, parent, time, description in cursor:
             prodversion = cls(env)
             prodversion.name = prodversion._old_name = name
             prodversion.parent = prodversion._old_parent = parent
             prodversion.time = time and datetime.fromtimestamp(int(time), utc) or None
             prodversion.description = description or ''
-            versions.append(prodversion)
-        def version_order(v):
-            return (v.time or utcmax, embedded_numbers(v.name))
-        return sorted(versions, key=version_order, reverse=True)
-    select = classmethod(select)
+            yield prodversion
+    select_page = classmethod(select_page)
+
+    sort_key = property(fget=lambda self: version_sort_key(self.name, self.time))
+
+    def insert_many(cls, env, rows, db=None):
+        """Creates several product versions using a single transaction.  Rows
+        are (name, parent, time, description) tuples.
+
+        If `db` is given, the caller is responsible for updating the catalog
+        revision, committing and resetting the catalog, once for all of its
+        changes."""
+        args = []
+        for name, parent, time, description in rows:
+            name = simplify_whitespace(name)
+            parent = simplify_whitespace(parent)
+            assert name, 'Cannot create product version with no name'
+            assert parent, 'Cannot create product version with no parent'
+            args.append((name, to_timestamp(time), description, parent,
+                         version_sort_key(name, time)))
+        db, handle_ta = ProductSystem(env).begin_write(db)
+
+        cursor = QueryStats(env).cursor(db)
+        env.log.debug("Creating %d new product versions" % len(args))
+        cursor.executemany("INSERT INTO multiproduct_product_version (name,time,description,parent,sort_key) "
+                           "VALUES (%s,%s,%s,%s,%s)", args)
+        ProductSystem(env).end_write(db, handle_ta, bulk=True)
+    insert_many = classmethod(insert_many)
+
+    def delete_many(cls, env, names, parent, db=None):
+        """Deletes several product versions of the same product using a single
+        transaction.  Names that don't exist are ignored.
+
+        If `db` is given, the caller is responsible for updating the catalog
+        revision, committing and resetting the catalog, once for all of its
+        changes."""
+        names = [simplify_whitespace(name) for name in names]
+        parent = simplify_whitespace(parent)
+        db, handle_ta = ProductSystem(env).begin_write(db)
+
+        cursor = QueryStats(env).cursor(db)
+        env.log.info('Deleting product versions %s' % ', '.join(names))
+        cursor.executemany("DELETE FROM multiproduct_product_version WHERE name=%s AND parent=%s",
+                           [(name, parent) for name in names])
+        _delete_depselect_options(env, cursor, 'product_version', names)
+        ProductSystem(env).end_write(db, handle_ta, bulk=True)
+    delete_many = classmethod(delete_many)
+
+
+class DepselectOption(object):
+    """Option of one of the depselect fields declared in trac.ini."""
 
+    _schema = [
+        Table('multiproduct_depselect_option', key=('field', 'parent', 'name'))[
+            Column('field'),
+            Column('parent'),
+            Column('name'),
+            ]
+        ]
 
-schema_ver = 1
-schema = Product._schema + ProductComponent._schema + ProductVersion._schema
+    def __init__(self, env, field, name=None, parent=None, db=None):
+        self.env = env
+        self.field = field
+        if name:
+            name = simplify_whitespace(name)
+        if parent:
+            parent = simplify_whitespace(parent)
+        if name and parent:
+            db = ProductSystem(self.env).get_db(db)
+            cursor = QueryStats(self.env).cursor(db)
+            cursor.execute("SELECT name FROM multiproduct_depselect_option "
+                           "WHERE field=%s AND parent=%s AND name=%s",
+                           (field, parent, name))
+            if not cursor.fetchone():
+                raise ResourceNotFound(_('Option %(name)s of %(field)s does not exist.',
+                                  name=name, field=field))
+            self.name = self._old_name = name
+            self.parent = self._old_parent = parent
+        else:
+            self.name = self._old_name = None
+            self.parent = self._old_parent = None
+
+    exists = property(fget=lambda self: self._old_name is not None)
+
+    def insert(self, db=None):
+        assert not self.exists, 'Cannot insert existing option'
+        self.name = simplify_whitespace(self.name)
+        self.parent = simplify_whitespace(self.parent)
+        assert self.name, 'Cannot create option with no name'
+        assert self.parent, 'Cannot create option with no parent'
+        db, handle_ta = ProductSystem(self.env).begin_write(db)
+
+        cursor = QueryStats(self.env).cursor(db)
+        self.env.log.debug("Creating new %s option '%s'" % (self.field, self.name))
+        cursor.execute("INSERT INTO multiproduct_depselect_option (field,parent,name) "
+                       "VALUES (%s,%s,%s)", (self.field, self.parent, self.name))
+        self._old_name = self.name
+        self._old_parent = self.parent
+
+        ProductSystem(self.env).end_write(db, handle_ta)
+
+    def select_records(cls, env, field, db=None, parent=None):
+        """Returns read-only records of the options of a field, optionally only
+        those belonging to one parent value."""
+        options = ProductSystem(env).get_catalog(db).get_options_list(field)
+        if parent:
+            options = [option for option in options if option[1] == parent]
+        return iter(options)
+    select_records = classmethod(select_records)
+
+    def insert_many(cls, env, rows, db=None):
+        """Creates several options using a single transaction.  Rows are
+        (field, parent, name) tuples.
+
+        If `db` is given, the caller is responsible for updating the catalog
+        revision, committing and resetting the catalog, once for all of its
+        changes."""
+        args = []
+        for field, parent, name in rows:
+            name = simplify_whitespace(name)
+            parent = simplify_whitespace(parent)
+            assert name, 'Cannot create option with no name'
+            assert parent, 'Cannot create option with no parent'
+            args.append((field, parent, name))
+        db, handle_ta = ProductSystem(env).begin_write(db)
+
+        cursor = QueryStats(env).cursor(db)
+        env.log.debug("Creating %d new depselect options" % len(args))
+        cursor.executemany("INSERT INTO multiproduct_depselect_option (field,parent,name) "
+                           "VALUES (%s,%s,%s)", args)
+        ProductSystem(env).end_write(db, handle_ta, bulk=True)
+    insert_many = classmethod(insert_many)
+
+    def delete_many(cls, env, field, names, parent, db=None):
+        """Deletes several options of a field with the same parent value using
+        a single transaction.  Names that don't exist are ignored.
+
+        If `db` is given, the caller is responsible for updating the catalog
+        revision, committing and resetting the catalog, once for all of its
+        changes."""
+        names = [simplify_whitespace(name) for name in names]
+        parent = simplify_whitespace(parent)
+        db, handle_ta = ProductSystem(env).begin_write(db)
+
+        cursor = QueryStats(env).cursor(db)
+        env.log.info('Deleting %s options %s' % (field, ', '.join(names)))
+        cursor.executemany("DELETE FROM multiproduct_depselect_option "
+                           "WHERE field=%s AND parent=%s AND name=%s",
+                           [(field, parent, name) for name in names])
+        _delete_depselect_options(env, cursor, field, names)
+        ProductSystem(env).end_write(db, handle_ta, bulk=True)
+    delete_many = classmethod(delete_many)
+
+
+def _get_dependent_fields(env, parent_field):
+    return [field['name'] for field in ProductSystem(env).get_depselect_fields()
+            if field['custom'] and field['parent'] == parent_field]
+
+def _update_depselect_parents(env, cursor, parent_field, old_value, new_value):
+    """Moves the options of the depselect fields that depend on `parent_field`
+    from one parent value to another."""
+    fields = _get_dependent_fields(env, parent_field)
+    if not fields:
+        return
+    cursor.executemany("UPDATE multiproduct_depselect_option SET parent=%s "
+                       "WHERE field=%s AND parent=%s",
+                       [(new_value, field, old_value) for field in fields])
+
+def _delete_depselect_options(env, cursor, parent_field, values):
+    """Deletes the options of the depselect fields that depend on
+    `parent_field` whose parent is one of `values`, once `parent_field` has no
+    value of that name left, and in turn the options that depend on those.
+    Product components and versions of the same name may exist in other
+    products, so their options only go with the last of them."""
+    fields = _get_dependent_fields(env, parent_field)
+    if not fields:
+        return
+    values = [value for value in set(values)
+              if not _depselect_value_exists(cursor, parent_field, value)]
+    for field in fields:
+        names = set()
+        for value in values:
+            cursor.execute("SELECT name FROM multiproduct_depselect_option "
+                           "WHERE field=%s AND parent=%s", (field, value))
+            names.update([name for name, in cursor.fetchall()])
+            cursor.execute("DELETE FROM multiproduct_depselect_option "
+                           "WHERE field=%s AND parent=%s", (field, value))
+        if names:
+            _delete_depselect_options(env, cursor, field, names)
+
+def _depselect_value_exists(cursor, field, value):
+    if field == 'product':
+        cursor.execute("SELECT name FROM multiproduct_product WHERE name=%s", (value,))
+    elif field == 'product_component':
+        cursor.execute("SELECT name FROM multiproduct_product_component WHERE name=%s",
+                       (value,))
+    elif field == 'product_version':
+        cursor.execute("SELECT name FROM multiproduct_product_version WHERE name=%s",
+                       (value,))
+    else:
+        cursor.execute("SELECT name FROM multiproduct_depselect_option "
+                       "WHERE field=%s AND name=%s", (field, value))
+    return cursor.fetchone() is not None
+
+
+def version_sort_key(name, time):
+    """Returns a key that sorts product versions by release date, unreleased
+    ones last, and then naturally by name, i.e. with embedded numbers compared
+    numerically.  Versions are listed in descending order of this key."""
+    if time:
+        key = '%020d' % to_timestamp(time)
+    else:
+        key = '9' * 20
+    pieces = _digits_re.split(name)
+    pieces[1::2] = ['%020d' % int(digits) for digits in pieces[1::2]]
+    return key + ' ' + ''.join(pieces)
+
+_digits_re = re.compile(r'(\d+)')
+
+
+schema_ver = 7
+schema = Product._schema + ProductComponent._schema + ProductVersion._schema + \
+         DepselectOption._schema + cascade.schema + summary.schema
+
+# The ticket table belongs to Trac, so indexes on the columns we add to it
+# can't be declared as part of a Table
+ticket_indexes = [
+    "CREATE INDEX ticket_product_product_component_idx "
+        "ON ticket (product,product_component)",
+    "CREATE INDEX ticket_product_product_version_idx "
+        "ON ticket (product,product_version)",
+    ]
@@ -0,0 +1,206 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import heapq
+import sys
+import threading
+import timeit
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from trac.admin import IAdminPanelProvider
+from trac.core import *
+from trac.config import BoolOption, IntOption
+from trac.web.api import IRequestFilter
+
+__all__ = ['QueryStats']
+
+
+class Statistics(object):
+    """Statement counts and timings, per model method, plus the slowest
+    statements seen."""
+
+    def __init__(self, slowest):
+        self.count = 0
+        self.time = 0.0
+        self.methods = {}
+        self.slowest = []
+        self._slowest_size = slowest
+
+    def record(self, method, sql, duration):
+        self.count += 1
+        self.time += duration
+        totals = self.methods.setdefault(method, [0, 0.0])
+        totals[0] += 1
+        totals[1] += duration
+        entry = (duration, method, sql)
+        if len(self.slowest) < self._slowest_size:
+            heapq.heappush(self.slowest, entry)
+        elif self.slowest and entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def merge(self, other):
+        for method, (count, duration) in other.methods.items():
+            totals = self.methods.setdefault(method, [0, 0.0])
+            totals[0] += count
+            totals[1] += duration
+        self.count += other.count
+        self.time += other.time
+        for entry in other.slowest:
+            if len(self.slowest) < self._slowest_size:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def get_slowest(self):
+        return sorted(self.slowest, reverse=True)
+
+
+class StatsCursor(object):
+    """Cursor wrapper that records every statement executed through it against
+    the model method that executed it."""
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, args=None):
+        start = timeit.default_timer()
+        try:
+            if args is None:
+                return self.cursor.execute(sql)
+            return self.cursor.execute(sql, args)
+        finally:
+            self.stats.record(_caller(), sql, timeit.default_timer() - start)
+
+    def executemany(self, sql, args):
+        start = timeit.default_timer()
+        try:
+            return self.cursor.executemany(sql, args)
+        finally:
+            self.stats.record(_caller(), sql, timeit.default_timer() - start)
+
+
+def _caller():
+    """Names the method two frames up, i.e. the one that called the cursor."""
+    frame = sys._getframe(2)
+    owner = frame.f_locals.get('self', frame.f_locals.get('cls'))
+    if owner is None:
+        return frame.f_code.co_name
+    if not isinstance(owner, type):
+        owner = type(owner)
+    return '%s.%s' % (owner.__name__, frame.f_code.co_name)
+
+
+class QueryStats(Component):
+    """Optionally counts and times the SQL statements issued by the plug-in
+    during each request.
+
+    Per-request figures are written to the log, and totals since the process
+    started are shown on an admin page."""
+
+    implements(IAdminPanelProvider, IRequestFilter)
+
+    enabled = BoolOption('multiproduct', 'query_stats', 'false',
+        """Whether to record the number and duration of the SQL statements
+        issued by the plug-in.""")
+
+    slowest = IntOption('multiproduct', 'query_stats_slowest', 10,
+        """Number of slowest statements to keep, per request and in total.""")
+
+    def __init__(self):
+        self._local = threading.local()
+        self._totals = Statistics(self.slowest)
+        self._requests = 0
+        self._totals_lock = threading.Lock()
+
+    def cursor(self, db):
+        """Returns a cursor for `db`, which records its statements if statistics
+        are enabled and a request is being processed."""
+        cursor = db.cursor()
+        stats = getattr(self._local, 'stats', None)
+        if stats is not None:
+            return StatsCursor(cursor, stats)
+        return cursor
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        # Requests that end in a redirect never reach post_process_request, so
+        # their statistics are finished at the start of the next request
+        self._finish()
+        if self.enabled:
+            self._local.stats = Statistics(self.slowest)
+            self._local.path = req.path_info
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        self._finish()
+        return template, data, content_type
+
+    # IAdminPanelProvider methods
+
+    def get_admin_panels(self, req):
+        if req.perm.has_permission('TRAC_ADMIN'):
+            yield ('ticket', 'Ticket System', 'querystats', 'Product Queries')
+
+    def render_admin_panel(self, req, cat, page, path_info):
+        req.perm.require('TRAC_ADMIN')
+        if req.method == 'POST' and req.args.get('reset'):
+            self._totals_lock.acquire()
+            try:
+                self._totals = Statistics(self.slowest)
+                self._requests = 0
+            finally:
+                self._totals_lock.release()
+            req.redirect(req.href.admin(cat, page))
+
+        totals = self._totals
+        methods = [(method, count, duration)
+                   for method, (count, duration) in totals.methods.items()]
+        methods.sort(key=lambda m: m[2], reverse=True)
+        data = {'enabled': self.enabled,
+                'requests': self._requests,
+                'count': totals.count,
+                'time': totals.time,
+                'methods': methods,
+                'slowest': totals.get_slowest()}
+        return 'admin_querystats.html', data
+
+    # Internal methods
+
+    def _finish(self):
+        stats = getattr(self._local, 'stats', None)
+        if stats is None:
+            return
+        self._local.stats = None
+        if not stats.count:
+            return
+
+        self.log.info('MultiProduct queries: %s', json.dumps({
+            'path': self._local.path,
+            'count': stats.count,
+            'time': round(stats.time, 6),
+            'methods': dict([(method, {'count': count, 'time': round(duration, 6)})
+                             for method, (count, duration) in stats.methods.items()]),
+            'slowest': [{'time': round(duration, 6), 'method': method, 'sql': sql}
+                        for duration, method, sql in stats.get_slowest()],
+            }, separators=(',', ':')))
+
+        self._totals_lock.acquire()
+        try:
+            self._totals.merge(stats)
+            self._requests += 1
+        finally:
+            self._totals_lock.release()
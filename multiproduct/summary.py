@@ -0,0 +1,222 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import sys
+
+from trac.core import *
+from trac.db import Table, Column
+from trac.ticket.api import ITicketChangeListener
+
+from multiproduct.api import IAdminCommandProvider
+from multiproduct.stats import QueryStats
+
+__all__ = ['TicketCountSummary']
+
+
+schema = [
+    Table('multiproduct_ticket_count', key=('product', 'component', 'version', 'status'))[
+        Column('product'),
+        Column('component'),
+        Column('version'),
+        Column('status'),
+        Column('tickets', type='int'),
+        ]
+    ]
+
+
+def _summary_key(values):
+    return (values.get('product') or '', values.get('product_component') or '',
+            values.get('product_version') or '', values.get('status') or '')
+
+
+class TicketCountSummary(Component):
+    """Maintains the number of tickets for every combination of product,
+    product component, product version and status.
+
+    Counts are adjusted as tickets are created, changed and deleted, and
+    recounted for the products involved whenever the model cascades a rename
+    to the tickets.  Empty ticket fields are counted under the empty string."""
+
+    implements(IAdminCommandProvider, ITicketChangeListener)
+
+    batch_size = 5000
+
+    def get_product_counts(self, db=None):
+        """Returns a dictionary of ticket counts by product."""
+        return self._get_counts("SELECT product,SUM(tickets) FROM multiproduct_ticket_count "
+                                "GROUP BY product", (), db)
+
+    def get_component_counts(self, product, db=None):
+        """Returns a dictionary of ticket counts by component of a product."""
+        return self._get_counts("SELECT component,SUM(tickets) FROM multiproduct_ticket_count "
+                                "WHERE product=%s GROUP BY component", (product,), db)
+
+    def get_version_counts(self, product, db=None):
+        """Returns a dictionary of ticket counts by version of a product."""
+        return self._get_counts("SELECT version,SUM(tickets) FROM multiproduct_ticket_count "
+                                "WHERE product=%s GROUP BY version", (product,), db)
+
+    def get_facets(self, products=None, db=None):
+        """Returns the ticket counts of the given products, or of all
+        products, nested by product, then by component or version, then by
+        status."""
+        if not db:
+            db = self.env.get_db_cnx()
+        cursor = QueryStats(self.env).cursor(db)
+        sql = "SELECT product,component,version,status,tickets FROM multiproduct_ticket_count"
+        args = ()
+        if products:
+            sql += " WHERE product IN (%s)" % ','.join(['%s'] * len(products))
+            args = tuple(products)
+        cursor.execute(sql, args)
+
+        facets = {}
+        for product, component, version, status, tickets in cursor:
+            facet = facets.get(product)
+            if facet is None:
+                facet = facets[product] = {'tickets': 0, 'status': {},
+                                           'components': {}, 'versions': {}}
+            facet['tickets'] += tickets
+            for counts in (facet['status'],
+                           facet['components'].setdefault(component, {}),
+                           facet['versions'].setdefault(version, {})):
+                counts[status] = counts.get(status, 0) + tickets
+        return facets
+
+    def adjust(self, db, deltas):
+        """Adds to the counts of the given keys, a dictionary of (product,
+        component, version, status) to the number of tickets gained or lost.
+        This does not commit.
+
+        Counts that don't exist yet are inserted.  If another transaction
+        inserts the same count first, the insert fails, so callers should
+        commit by way of `commit_with_retry`."""
+        cursor = QueryStats(self.env).cursor(db)
+        for key, delta in deltas.items():
+            if not delta:
+                continue
+            cursor.execute("UPDATE multiproduct_ticket_count SET tickets=tickets+%s "
+                           "WHERE product=%s AND component=%s AND version=%s AND status=%s",
+                           (delta,) + key)
+            if not cursor.rowcount and delta > 0:
+                self._insert_counts(cursor, {key: delta})
+            elif delta < 0:
+                cursor.execute("DELETE FROM multiproduct_ticket_count "
+                               "WHERE product=%s AND component=%s AND version=%s "
+                               "AND status=%s AND tickets<=0", key)
+
+    def commit_with_retry(self, db, write):
+        """Calls `write`, which changes the database through `db`, including
+        calls to `adjust`, and commits.  If a count inserted by `adjust` was
+        inserted by another transaction first, the transaction is rolled back
+        and `write` called once more, which then finds the count to update."""
+        try:
+            write()
+            db.commit()
+        except Exception, e:
+            # Each database module has its own IntegrityError
+            if e.__class__.__name__ != 'IntegrityError':
+                raise
+            self.log.debug('Ticket count inserted concurrently, writing again')
+            db.rollback()
+            write()
+            db.commit()
+
+    def recount(self, db, products):
+        """Recounts the tickets of the given products from the ticket table.
+        This does not commit, it is meant to be called in the same transaction
+        as the change that moved the tickets."""
+        cursor = QueryStats(self.env).cursor(db)
+        for product in set(products):
+            cursor.execute("DELETE FROM multiproduct_ticket_count WHERE product=%s",
+                           (product,))
+            cursor.execute("SELECT product_component,product_version,status,COUNT(*) "
+                           "FROM ticket WHERE product=%s "
+                           "GROUP BY product_component,product_version,status",
+                           (product,))
+            counts = {}
+            for component, version, status, tickets in cursor.fetchall():
+                key = (product, component or '', version or '', status or '')
+                counts[key] = counts.get(key, 0) + tickets
+            self._insert_counts(cursor, counts)
+
+    def rebuild(self):
+        """Recounts all tickets, reading the ticket table in batches so that it
+        is never locked for long, and replaces the summary in one
+        transaction."""
+        db = self.env.get_db_cnx()
+        cursor = QueryStats(self.env).cursor(db)
+        counts = {}
+        last_id = 0
+        while True:
+            cursor.execute("SELECT id,product,product_component,product_version,status "
+                           "FROM ticket WHERE id>%%s ORDER BY id LIMIT %d"
+                           % self.batch_size, (last_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for id, product, component, version, status in rows:
+                key = (product or '', component or '', version or '', status or '')
+                counts[key] = counts.get(key, 0) + 1
+            last_id = rows[-1][0]
+
+        cursor.execute("DELETE FROM multiproduct_ticket_count")
+        self._insert_counts(cursor, counts)
+        db.commit()
+        return counts
+
+    # ITicketChangeListener methods
+
+    def ticket_created(self, ticket):
+        self._adjust_now({_summary_key(ticket.values): 1})
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        new_key = _summary_key(ticket.values)
+        values = dict(ticket.values)
+        values.update(old_values)
+        old_key = _summary_key(values)
+        if old_key != new_key:
+            self._adjust_now({old_key: -1, new_key: 1})
+
+    def ticket_deleted(self, ticket):
+        self._adjust_now({_summary_key(ticket.values): -1})
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('product count rebuild', '',
+               """Rebuild the ticket count summary
+
+               Recounts the tickets of every product, product component,
+               product version and status from scratch.""",
+               None, self._do_rebuild)
+
+    # Internal methods
+
+    def _do_rebuild(self):
+        counts = self.rebuild()
+        sys.stdout.write('Counted %d tickets in %d groups\n'
+                         % (sum(counts.values()), len(counts)))
+
+    def _get_counts(self, sql, args, db):
+        if not db:
+            db = self.env.get_db_cnx()
+        cursor = QueryStats(self.env).cursor(db)
+        cursor.execute(sql, args)
+        return dict([(name, int(tickets)) for name, tickets in cursor])
+
+    def _adjust_now(self, deltas):
+        db = self.env.get_db_cnx()
+        self.commit_with_retry(db, lambda: self.adjust(db, deltas))
+
+    def _insert_counts(self, cursor, counts):
+        # An empty executemany would run the statement without any arguments
+        if not counts:
+            return
+        cursor.executemany("INSERT INTO multiproduct_ticket_count "
+                           "(product,component,version,status,tickets) "
+                           "VALUES (%s,%s,%s,%s,%s)",
+                           [key + (tickets,) for key, tickets in counts.items()])
@@ -0,0 +1,20 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import unittest
+
+from multiproduct.tests import console, model, summary
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(console.suite())
+    suite.addTest(model.suite())
+    suite.addTest(summary.suite())
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,82 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import sys
+import unittest
+from StringIO import StringIO
+
+from trac.test import EnvironmentStub
+
+from multiproduct.console import ProductAdminCommands
+from multiproduct.main import MultiProductPlugin
+from multiproduct.model import Product, ProductComponent
+
+
+class ProductCheckTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'multiproduct.*'])
+        self.env.config.set('multiproduct', 'catalog_snapshot', '')
+        MultiProductPlugin(self.env).environment_created()
+        product = Product(self.env)
+        product.name = 'Product 1'
+        product.insert()
+        component = ProductComponent(self.env)
+        component.name, component.parent = 'Component 1', 'Product 1'
+        component.insert()
+
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.executemany("INSERT INTO ticket (time,changetime,status,summary,product,"
+                           "product_component) VALUES (0,0,'new','Summary',%s,%s)",
+                           [('Product 1', 'Component 1'),
+                            ('Product 1', 'Component 2'),
+                            (None, 'Component 1'),
+                            ('Product 2', 'Component 1')])
+        db.commit()
+
+    def _check(self, *args):
+        stdout = sys.stdout
+        sys.stdout = out = StringIO()
+        try:
+            ProductAdminCommands(self.env)._do_check(*args)
+        finally:
+            sys.stdout = stdout
+        return out.getvalue().splitlines()
+
+    def _get_tickets(self):
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT product,product_component FROM ticket ORDER BY id")
+        return cursor.fetchall()
+
+    def test_report(self):
+        self.assertEqual(['product Product 2: 1 tickets',
+                          'component /Component 1: 1 tickets',
+                          'component Product 1/Component 2: 1 tickets',
+                          '1 tickets with unknown products, 2 with unknown '
+                          'components, 0 with unknown versions'],
+                         self._check())
+        self.assertEqual(4, len(self._get_tickets()))
+
+    def test_clear(self):
+        self._check('clear')
+        self.assertEqual([('Product 1', 'Component 1'), ('Product 1', None),
+                          (None, None), (None, None)],
+                         self._get_tickets())
+
+    def test_reassign(self):
+        self._check('reassign', 'Product 1')
+        self.assertEqual([('Product 1', 'Component 1'), ('Product 1', None),
+                          (None, None), ('Product 1', 'Component 1')],
+                         self._get_tickets())
+
+
+def suite():
+    return unittest.makeSuite(ProductCheckTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
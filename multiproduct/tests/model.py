@@ -0,0 +1,170 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import unittest
+
+from trac.test import EnvironmentStub
+
+from multiproduct.api import ProductSystem
+from multiproduct.main import MultiProductPlugin
+from multiproduct.model import Product, ProductComponent, ProductVersion
+from multiproduct.summary import TicketCountSummary
+
+
+class ProductTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'multiproduct.*'])
+        self.env.config.set('multiproduct', 'catalog_snapshot', '')
+        MultiProductPlugin(self.env).environment_created()
+        product = Product(self.env)
+        product.name = 'Product 1'
+        product.insert()
+
+    def _insert_ticket(self, product):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("INSERT INTO ticket (time,changetime,status,summary,product) "
+                       "VALUES (0,0,'new','Summary',%s)", (product,))
+        db.commit()
+
+    def _get_ticket_products(self):
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT product FROM ticket ORDER BY id")
+        return [product for product, in cursor]
+
+    def test_rename(self):
+        self._insert_ticket('Product 1')
+        self._insert_ticket('Product 1')
+        TicketCountSummary(self.env).rebuild()
+
+        product = Product(self.env, 'Product 1')
+        product.name = 'Product 2'
+        product.update()
+
+        self.assertEqual('Product 2', Product(self.env, 'Product 2').name)
+        self.assertEqual(['Product 2', 'Product 2'], self._get_ticket_products())
+        self.assertEqual({'Product 2': 2},
+                         TicketCountSummary(self.env).get_product_counts())
+
+    def test_rename_without_tickets(self):
+        product = Product(self.env, 'Product 1')
+        product.name = 'Product 2'
+        product.update()
+
+        self.assertEqual(['Product 2'],
+                         [p.name for p in Product.select(self.env)])
+        self.assertEqual({}, TicketCountSummary(self.env).get_product_counts())
+
+    def test_rolled_back_insert_not_cached(self):
+        uow = ProductSystem(self.env).unit_of_work()
+        uow.__enter__()
+        try:
+            product = Product(self.env)
+            product.name = 'Product 2'
+            product.insert()
+            self.assertEqual(['Product 1', 'Product 2'],
+                             [p.name for p in Product.select(self.env)])
+        finally:
+            uow.__exit__(RuntimeError, RuntimeError(), None)
+
+        self.assertEqual(['Product 1'], [p.name for p in Product.select(self.env)])
+
+
+class ProductOptionTestCase(unittest.TestCase):
+    """Renames and moves of product components and versions, which have to
+    follow through to the tickets."""
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'multiproduct.*'])
+        self.env.config.set('multiproduct', 'catalog_snapshot', '')
+        MultiProductPlugin(self.env).environment_created()
+        for name in ('Product 1', 'Product 2'):
+            product = Product(self.env)
+            product.name = name
+            product.insert()
+        component = ProductComponent(self.env)
+        component.name, component.parent = 'Component 1', 'Product 1'
+        component.insert()
+        version = ProductVersion(self.env)
+        version.name, version.parent = '1.0', 'Product 1'
+        version.insert()
+
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("INSERT INTO ticket (time,changetime,status,summary,product,"
+                       "product_component,product_version) "
+                       "VALUES (0,0,'new','Summary','Product 1','Component 1','1.0')")
+        db.commit()
+        TicketCountSummary(self.env).rebuild()
+
+    def _get_ticket(self):
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT product,product_component,product_version FROM ticket")
+        return cursor.fetchone()
+
+    def test_rename_component(self):
+        component = ProductComponent(self.env, 'Component 1', 'Product 1')
+        component.name = 'Component 2'
+        component.update()
+
+        self.assertEqual(['Component 2'],
+                         [c.name for c in ProductComponent.select(self.env)])
+        self.assertEqual(('Product 1', 'Component 2', '1.0'), self._get_ticket())
+
+    def test_move_component(self):
+        component = ProductComponent(self.env, 'Component 1', 'Product 1')
+        component.parent = 'Product 2'
+        component.update()
+
+        self.assertEqual('Product 2',
+                         ProductComponent(self.env, 'Component 1', 'Product 2').parent)
+        self.assertEqual(('Product 2', 'Component 1', '1.0'), self._get_ticket())
+        self.assertEqual({'Product 2': 1},
+                         TicketCountSummary(self.env).get_product_counts())
+
+    def test_rename_version(self):
+        version = ProductVersion(self.env, '1.0', 'Product 1')
+        version.name = '2.0'
+        version.update()
+
+        self.assertEqual(['2.0'], [v.name for v in ProductVersion.select(self.env)])
+        self.assertEqual(('Product 1', 'Component 1', '2.0'), self._get_ticket())
+
+    def test_move_version(self):
+        version = ProductVersion(self.env, '1.0', 'Product 1')
+        version.parent = 'Product 2'
+        version.update()
+
+        self.assertEqual('Product 2', ProductVersion(self.env, '1.0', 'Product 2').parent)
+        self.assertEqual(('Product 2', 'Component 1', '1.0'), self._get_ticket())
+        self.assertEqual({'Product 2': 1},
+                         TicketCountSummary(self.env).get_product_counts())
+
+    def test_rename_component_during_product_rename(self):
+        self.env.config.set('multiproduct', 'deferred_rename_cascade', 'true')
+        product = Product(self.env, 'Product 1')
+        product.name = 'Product 3'
+        product.update()
+        self.assertEqual(('Product 1', 'Component 1', '1.0'), self._get_ticket())
+
+        component = ProductComponent(self.env, 'Component 1', 'Product 3')
+        component.name = 'Component 2'
+        component.update()
+
+        self.assertEqual(('Product 3', 'Component 2', '1.0'), self._get_ticket())
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ProductTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ProductOptionTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,57 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import unittest
+
+from trac.test import EnvironmentStub
+
+from multiproduct.main import MultiProductPlugin
+from multiproduct.summary import TicketCountSummary
+
+
+class TicketCountSummaryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'multiproduct.*'])
+        self.env.config.set('multiproduct', 'catalog_snapshot', '')
+        MultiProductPlugin(self.env).environment_created()
+        self.summary = TicketCountSummary(self.env)
+
+    def test_adjust(self):
+        db = self.env.get_db_cnx()
+        key = ('Product 1', 'Component 1', '', 'new')
+        self.summary.adjust(db, {key: 2})
+        self.summary.adjust(db, {key: -1})
+        db.commit()
+        self.assertEqual({'Product 1': 1}, self.summary.get_product_counts())
+        self.summary.adjust(db, {key: -1})
+        db.commit()
+        self.assertEqual({}, self.summary.get_product_counts())
+
+    def test_commit_with_retry(self):
+        # The first attempt runs into a count inserted by "another
+        # transaction", the second one finds it and updates it
+        db = self.env.get_db_cnx()
+        key = ('Product 1', '', '', 'new')
+        attempts = []
+        def write():
+            attempts.append(1)
+            if len(attempts) == 1:
+                self.summary.adjust(db, {key: 1})
+                self.summary._insert_counts(db.cursor(), {key: 1})
+            else:
+                self.summary.adjust(db, {key: 1})
+        self.summary.commit_with_retry(db, write)
+        self.assertEqual(2, len(attempts))
+        self.assertEqual({'Product 1': 1}, self.summary.get_product_counts())
+
+
+def suite():
+    return unittest.makeSuite(TicketCountSummaryTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -4,16 +4,22 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 from genshi.builder import tag
+from genshi.core import Markup
 from genshi.filters import Transformer
 
 from trac.core import *
-from trac.config import Option
+from trac.config import IntOption, Option
 from trac.ticket.api import ITicketManipulator
-from trac.web.api import ITemplateStreamFilter
-from trac.web.chrome import add_script
+from trac.web.api import IRequestFilter, ITemplateStreamFilter
+from trac.web.chrome import add_script, add_stylesheet
 
-from multiproduct import model
+from multiproduct.api import ProductSystem
 
 __all__ = ['TicketExtensions']
 
@@ -21,13 +27,58 @@ __all__ = ['TicketExtensions']
 class TicketExtensions(Component):
     """Provides some extensions to the ticket model behaviour."""
 
-    implements(ITicketManipulator, ITemplateStreamFilter)
+    implements(IRequestFilter, ITicketManipulator, ITemplateStreamFilter)
 
     # Config options
 
     default_product = Option('ticket', 'default_product', '',
         """Default product for newly created tickets.""")
 
+    autocomplete_threshold = IntOption('multiproduct', 'autocomplete_threshold', 0,
+        """Number of options above which the Product field and depselect
+        fields on ticket pages become text inputs that suggest matching options
+        as the user types, instead of listing them all.  0 never does.""")
+
+    def __init__(self):
+        # Serialized options of the hidden selects, for the catalog they were
+        # rendered from
+        self._fragments = {}
+        self._fragments_catalog = None
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        """Trims the options of depselect fields down to those belonging to the
+        ticket's current parent value.  Options for other values are fetched
+        by the browser from the DepselectModule when they are needed."""
+        if template == 'ticket.html' and data and 'fields' in data:
+            ticket = data['ticket']
+            threshold = self.autocomplete_threshold
+            for field in data['fields']:
+                if field['name'] == 'product' and threshold and \
+                        len(field['options']) > threshold:
+                    value = ticket.get_value_or_default('product')
+                    field['options'] = value and [value] or []
+                    field['autocomplete'] = True
+                if field['type'] != 'depselect':
+                    continue
+                parent_val = ticket.get_value_or_default(field['parent'])
+                # Field dicts are copies but their options are shared with the
+                # ticket field cache, so replace the list rather than edit it
+                field['options'] = [(val, par) for val, par in field['options']
+                                    if par == parent_val]
+                # Too many options to list, only the current one is kept and
+                # the others are suggested by the AutocompleteModule
+                if threshold and len(field['options']) > threshold:
+                    value = ticket.get_value_or_default(field['name'])
+                    field['options'] = [(val, par) for val, par in field['options']
+                                        if val == value]
+                    field['autocomplete'] = True
+        return template, data, content_type
+
     # ITicketManipulator methods
 
     def prepare_ticket(self, req, ticket, fields, actions):
@@ -36,19 +87,23 @@ class TicketExtensions(Component):
 
     def validate_ticket(self, req, ticket):
         """Used to default the owner field to the product owner, if it's left blank by
-        the user."""
-
-        db = self.env.get_db_cnx()
-
-        if ticket.values.get('product') and not ticket.values.get('owner'):
-            try:
-                product = model.Product(self.env, ticket['product'], db=db)
-                if product.owner:
-                    ticket['owner'] = product.owner
-                    self.log.info("Setting ticket owner to product owner")
-            except ResourceNotFound, e:
-                # Don't bother if the product doesn't exist
-                pass
+        the user, and to move tickets off the old name of a renamed product."""
+
+        # Product owners are looked up in the cached catalog, so this doesn't
+        # cost a trip to the database
+        catalog = ProductSystem(self.env).get_catalog()
+        product = ticket.values.get('product')
+
+        # Don't let tickets of a product that is being renamed in the
+        # background go back to the old name
+        if product in catalog.renames:
+            ticket['product'] = product = catalog.renames[product]
+
+        if product and not ticket.values.get('owner'):
+            owner = catalog.owners.get(product)
+            if owner:
+                ticket['owner'] = owner
+                self.log.info("Setting ticket owner to product owner")
         return []
 
     # ITemplateStreamFilter methods
@@ -62,20 +117,70 @@ class TicketExtensions(Component):
         if not filename == 'ticket.html':
             return stream
 
-        # Iterate through the list of all the depselect fields
-        for d in [f for f in data['fields'] if f['type'] == 'depselect']:
+        catalog = ProductSystem(self.env).get_catalog()
+        elms = []
+
+        # Iterate through the list of all the depselect fields, except those
+        # whose options are suggested rather than listed
+        for d in [f for f in data['fields']
+                  if f['type'] == 'depselect' and not f.get('autocomplete')]:
 
             # Add a hidden select for every depselect field
-            elm = tag.select(style="display: none", id='field-%s%s' % (d['parent'], d['name']))
-            if d['optional']:
-                elm(tag.option)
+            parent_val = data['ticket'].get_value_or_default(d['parent'])
             ticket_val = data['ticket'].get_value_or_default(d['name'])
-            for val, parent_val in d['options']:
-                if ticket_val == val:
-                    elm(tag.option(val, class_=parent_val, selected='selected'))
-                else:
-                    elm(tag.option(val, class_=parent_val))
-            stream |= Transformer('.//body').append(elm)
+            options = self._get_fragment(catalog, d, parent_val, ticket_val)
+            elms.append(tag.select(options, style="display: none",
+                                   id='field-%s%s' % (d['parent'], d['name'])))
+
+        # Tell the script which fields depend on which, and where to fetch the
+        # options for other parent values
+        depselects = [(d['name'], d['parent']) for d in data['fields']
+                      if d['type'] == 'depselect']
+        autocomplete = [f['name'] for f in data['fields'] if f.get('autocomplete')]
+        script = 'var multiproduct_depselects = %s;\n' \
+                 'var multiproduct_autocomplete = %s;\n' \
+                 'var multiproduct_options_url = "%s";\n' \
+                 'var multiproduct_complete_url = "%s";' \
+                 % (json.dumps(depselects, separators=(',', ':')),
+                    json.dumps(autocomplete, separators=(',', ':')),
+                    req.href.multiproduct('options'), req.href.multiproduct('complete'))
+        elms.append(tag.script(Markup(script), type='text/javascript'))
+        if autocomplete:
+            add_stylesheet(req, 'multiproduct/css/multiproduct.css')
+
+        stream |= Transformer('.//body').append(tag(*elms))
 
         add_script(req, 'multiproduct/js/ticket_depselect_fettler.js')
         return stream
+
+    # Internal methods
+
+    def _get_fragment(self, catalog, field, parent_val, ticket_val):
+        """Returns the options of a hidden select as markup.  The options are
+        only serialized once for each catalog, after that only the selected
+        option is rendered per request."""
+        if self._fragments_catalog is not catalog:
+            self._fragments = {}
+            self._fragments_catalog = catalog
+        key = (field['name'], parent_val, field['optional'])
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            markup = []
+            offsets = {}
+            length = 0
+            if field['optional']:
+                markup.append(Markup('<option></option>'))
+                length += len(markup[-1])
+            for val in catalog.get_options(field['name'], parent_val):
+                markup.append(Markup('<option class="%s">%s</option>') % (parent_val, val))
+                offsets[val] = (length, length + len(markup[-1]))
+                length += len(markup[-1])
+            fragment = self._fragments[key] = (Markup('').join(markup), offsets)
+
+        markup, offsets = fragment
+        if ticket_val in offsets:
+            start, end = offsets[ticket_val]
+            selected = Markup('<option class="%s" selected="selected">%s</option>') \
+                       % (parent_val, ticket_val)
+            markup = Markup(markup[:start]) + selected + Markup(markup[end:])
+        return markup
@@ -4,5 +4,103 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+from datetime import datetime
+
+from trac.db import DatabaseManager
+from trac.util.datefmt import utc
+
+from multiproduct import cascade, summary
+from multiproduct.model import DepselectOption, product_path, ticket_indexes, \
+                                version_sort_key
+
+
+def add_ticket_indexes(env, db):
+    """Add indexes on the product fields of the ticket table, so that renaming
+    products, product components and product versions does not require a full
+    scan of the ticket table."""
+    cursor = db.cursor()
+    for stmt in ticket_indexes:
+        cursor.execute(stmt)
+
+
+def add_product_rename_table(env, db):
+    """Add a table to track the progress of product renames that are cascaded to
+    tickets in the background."""
+    connector, _ = DatabaseManager(env)._get_connector()
+    cursor = db.cursor()
+    for table in cascade.schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
+
+
+def add_version_sort_key(env, db):
+    """Add a natural sort key column to the product version table, so that
+    versions can be listed in order by the database."""
+    cursor = db.cursor()
+    cursor.execute("ALTER TABLE multiproduct_product_version ADD COLUMN sort_key TEXT")
+    cursor.execute("SELECT parent,name,time FROM multiproduct_product_version")
+    rows = cursor.fetchall()
+    if rows:
+        cursor.executemany("UPDATE multiproduct_product_version SET sort_key=%s "
+                           "WHERE parent=%s AND name=%s",
+                           [(version_sort_key(name, time and
+                                              datetime.fromtimestamp(int(time), utc)),
+                             parent, name) for parent, name, time in rows])
+    cursor.execute("CREATE INDEX multiproduct_product_version_parent_sort_key_idx "
+                   "ON multiproduct_product_version (parent,sort_key)")
+
+
+def add_ticket_count_table(env, db):
+    """Add a table of ticket counts by product, product component, product
+    version and status, and count the existing tickets into it."""
+    connector, _ = DatabaseManager(env)._get_connector()
+    cursor = db.cursor()
+    for table in summary.schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
+    cursor.execute("SELECT product,product_component,product_version,status,COUNT(*) "
+                   "FROM ticket GROUP BY product,product_component,product_version,status")
+    counts = {}
+    for product, component, version, status, tickets in cursor.fetchall():
+        key = (product or '', component or '', version or '', status or '')
+        counts[key] = counts.get(key, 0) + tickets
+    if counts:
+        cursor.executemany("INSERT INTO multiproduct_ticket_count "
+                           "(product,component,version,status,tickets) "
+                           "VALUES (%s,%s,%s,%s,%s)",
+                           [key + (tickets,) for key, tickets in counts.items()])
+
+
+def add_product_hierarchy(env, db):
+    """Add parent and materialized path columns to the product table, so that
+    products can be arranged in a hierarchy."""
+    cursor = db.cursor()
+    cursor.execute("ALTER TABLE multiproduct_product ADD COLUMN parent TEXT")
+    cursor.execute("ALTER TABLE multiproduct_product ADD COLUMN path TEXT")
+    cursor.execute("SELECT name FROM multiproduct_product")
+    names = [name for name, in cursor.fetchall()]
+    if names:
+        cursor.executemany("UPDATE multiproduct_product SET path=%s WHERE name=%s",
+                           [(product_path(name), name) for name in names])
+    cursor.execute("CREATE INDEX multiproduct_product_path_idx "
+                   "ON multiproduct_product (path)")
+
+
+def add_depselect_option_table(env, db):
+    """Add a table for the options of depselect fields declared in
+    trac.ini."""
+    connector, _ = DatabaseManager(env)._get_connector()
+    cursor = db.cursor()
+    for table in DepselectOption._schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
+
+
 map = {
+    2: [add_ticket_indexes],
+    3: [add_product_rename_table],
+    4: [add_version_sort_key],
+    5: [add_ticket_count_table],
+    6: [add_product_hierarchy],
+    7: [add_depselect_option_table],
 }
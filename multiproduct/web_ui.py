@@ -0,0 +1,203 @@
+# Copyright (C) 2009 Mat Booth <mat@matbooth.co.uk>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import re
+import threading
+import time
+from bisect import bisect_left
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from trac.core import *
+from trac.config import IntOption
+from trac.util.datefmt import http_date
+from trac.web.api import IRequestHandler
+
+from multiproduct.api import ProductSystem
+from multiproduct.summary import TicketCountSummary
+
+__all__ = ['AutocompleteModule', 'DepselectModule', 'FacetModule']
+
+
+class DepselectModule(Component):
+    """Serves the options of depselect fields on demand, so that ticket pages
+    only need to contain the options for the ticket's current product."""
+
+    implements(IRequestHandler)
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        match = re.match(r'/multiproduct/options/(\w+)$', req.path_info)
+        if match:
+            req.args['field'] = match.group(1)
+            return True
+
+    def process_request(self, req):
+        req.perm.require('TICKET_VIEW')
+
+        system = ProductSystem(self.env)
+        catalog = system.get_catalog()
+        field = req.args.get('field')
+        if field not in [f['name'] for f in system.get_depselect_fields()]:
+            raise TracError('No depselect field named %s' % field)
+        parent = req.args.get('parent', '')
+
+        # The catalog revision changes with every write, so it is all the
+        # browser needs to tell whether its copy is still current
+        modified = catalog.get_modified()
+        req.check_modified(modified, str(catalog.revision))
+        req.send_header('Last-Modified', http_date(modified))
+
+        content = json.dumps(catalog.get_options(field, parent),
+                             separators=(',', ':'))
+        req.send(content, 'application/json')
+
+
+class FacetModule(Component):
+    """Serves ticket counts by product, then by product component or product
+    version, then by status, from the ticket count summary.
+
+    `/multiproduct/facets` returns the counts of every product, and may be
+    narrowed down with one or more `product` arguments, or with `under`
+    arguments naming products whose whole subtree is wanted."""
+
+    implements(IRequestHandler)
+
+    cache_ttl = IntOption('multiproduct', 'facet_cache_ttl', 30,
+        """Number of seconds for which ticket counts are served from memory.
+        Counts are always recomputed after the product catalog changes.""")
+
+    def __init__(self):
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        return req.path_info == '/multiproduct/facets'
+
+    def process_request(self, req):
+        req.perm.require('TICKET_VIEW')
+
+        catalog = ProductSystem(self.env).get_catalog()
+        products = []
+        for arg in ('product', 'under'):
+            values = req.args.get(arg) or []
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                if arg == 'under':
+                    products.extend(catalog.get_subtree(value))
+                else:
+                    products.append(value)
+        key = tuple(sorted(set(products)))
+        products = list(key)
+
+        revision = catalog.revision
+        now = time.time()
+        entry = self._cache.get(key)
+        if entry is None or entry[0] != revision or entry[1] <= now:
+            facets = TicketCountSummary(self.env).get_facets(products)
+            entry = (revision, now + self.cache_ttl,
+                     json.dumps(facets, separators=(',', ':')))
+            self._cache_lock.acquire()
+            try:
+                # Drop whatever has gone stale rather than letting the cache
+                # grow with every combination of products ever asked for
+                for stale in [k for k, e in self._cache.items()
+                              if e[0] != revision or e[1] <= now]:
+                    del self._cache[stale]
+                self._cache[key] = entry
+            finally:
+                self._cache_lock.release()
+
+        req.send_header('Cache-Control', 'max-age=%d' % max(0, int(entry[1] - now)))
+        req.send(entry[2], 'application/json')
+
+
+class PrefixIndex(object):
+    """Names sorted case-insensitively, so that those starting with a prefix
+    can be found by bisection."""
+
+    def __init__(self, names):
+        self._keys = [(name.lower(), name) for name in names]
+        self._keys.sort()
+
+    def search(self, prefix, limit):
+        """Returns up to `limit` names starting with `prefix`, in order."""
+        prefix = prefix.lower()
+        keys = self._keys
+        matches = []
+        i = bisect_left(keys, (prefix,))
+        while i < len(keys) and len(matches) < limit and keys[i][0].startswith(prefix):
+            matches.append(keys[i][1])
+            i += 1
+        return matches
+
+
+class AutocompleteModule(Component):
+    """Suggests products and the options of depselect fields matching what a
+    user has typed so far.
+
+    `/multiproduct/complete/<field>?q=<prefix>&parent=<value>` returns the
+    first names of the field starting with the prefix, ignoring case, for
+    fields with too many options to list.  The names are looked up in prefix
+    indexes that are built on first use for each catalog."""
+
+    implements(IRequestHandler)
+
+    max_limit = 50
+
+    def __init__(self):
+        # Catalog and the indexes built from it, replaced in one assignment
+        self._indexes = (None, {})
+
+    def get_index(self, field, parent=None):
+        """Returns the prefix index of the products, or of the options of a
+        depselect field belonging to one parent value."""
+        catalog = ProductSystem(self.env).get_catalog()
+        indexes_catalog, indexes = self._indexes
+        if indexes_catalog is not catalog:
+            indexes = {}
+            self._indexes = (catalog, indexes)
+        key = (field, parent)
+        index = indexes.get(key)
+        if index is None:
+            if field == 'product':
+                names = [row[0] for row in catalog.products]
+            else:
+                names = catalog.get_options(field, parent)
+            # Two threads may build the same index at once, which is harmless
+            index = indexes[key] = PrefixIndex(names)
+        return index
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        match = re.match(r'/multiproduct/complete/(\w+)$', req.path_info)
+        if match:
+            req.args['field'] = match.group(1)
+            return True
+
+    def process_request(self, req):
+        req.perm.require('TICKET_VIEW')
+
+        field = req.args.get('field')
+        if field != 'product' and field not in \
+                [f['name'] for f in ProductSystem(self.env).get_depselect_fields()]:
+            raise TracError('No product or depselect field named %s' % field)
+        parent = field != 'product' and req.args.get('parent', '') or None
+        try:
+            limit = min(int(req.args.get('limit', 10)), self.max_limit)
+        except ValueError:
+            limit = 10
+
+        matches = self.get_index(field, parent).search(req.args.get('q', ''), limit)
+        req.send(json.dumps(matches, separators=(',', ':')), 'application/json')
+
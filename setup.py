@@ -27,8 +27,18 @@ setup(
     entry_points={
         'trac.plugins': [
            'multiproduct.admin = multiproduct.admin',
+           'multiproduct.api = multiproduct.api',
+           'multiproduct.cascade = multiproduct.cascade',
+           'multiproduct.console = multiproduct.console',
            'multiproduct.main = multiproduct.main',
+           'multiproduct.stats = multiproduct.stats',
+           'multiproduct.summary = multiproduct.summary',
            'multiproduct.ticket = multiproduct.ticket',
+           'multiproduct.web_ui = multiproduct.web_ui',
+           ],
+        'console_scripts': [
+           'multiproduct-admin = multiproduct.console:main',
            ]
         },
-    install_requires = [])
+    install_requires = [],
+    test_suite = 'multiproduct.tests.suite')